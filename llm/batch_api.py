@@ -0,0 +1,69 @@
+import asyncio
+import json
+import os
+
+from llm.models import shared_http
+
+"""
+Minimal client of the OpenAI Batch API (the pinned openai package predates it), for non-interactive LLM requests that
+don't need an answer within seconds. The requests of a batch job are answered within the completion window (24h) at
+half the price and don't count against the rate limits of the synchronous requests.
+The extraction waits for the job within a request of the web app, so a job not finished within REFCHECK_BATCH_API_TIMEOUT
+seconds (default 15 minutes) is cancelled and its requests are sent synchronously by the caller instead.
+"""
+
+OPENAI_API_BASE = os.environ.get("OPENAI_API_BASE", "https://api.openai.com/v1")
+BATCH_TIMEOUT = float(os.environ.get("REFCHECK_BATCH_API_TIMEOUT", 900))
+# the states of a batch job after which it doesn't change anymore
+FINAL_STATES = {"completed", "failed", "expired", "cancelled"}
+
+
+def _headers() -> dict:
+    return {"Authorization": f"Bearer {os.environ['OPENAI_API_KEY']}"}
+
+
+async def run_batch(bodies: dict[str, dict], api_base: str = None, poll_interval: float = 60.0,
+                    timeout: float = BATCH_TIMEOUT) -> dict[str, dict]:
+    """
+    Submits the chat completion requests as one batch job and waits until the job is finished.
+    :param bodies: the request bodies of the chat completions endpoint by custom id
+    :param api_base: the base url of the OpenAI API (e.g. the openai_api_base of the model), OPENAI_API_BASE if not given
+    :param poll_interval: the seconds waited between the status requests of the job
+    :param timeout: the seconds waited for the job at most, afterwards it is cancelled and no results are returned
+    :return: the response bodies by custom id, failed requests are missing
+    """
+    api_base = (api_base or OPENAI_API_BASE).rstrip("/")
+    lines = "\n".join(json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body})
+                      for custom_id, body in bodies.items())
+    response = await shared_http.post(f"{api_base}/files", headers=_headers(), data={"purpose": "batch"},
+                                      files={"file": ("batch_requests.jsonl", lines.encode())})
+    response.raise_for_status()
+    response = await shared_http.post(f"{api_base}/batches", headers=_headers(),
+                                      json={"input_file_id": response.json()["id"], "endpoint": "/v1/chat/completions",
+                                            "completion_window": "24h"})
+    response.raise_for_status()
+    batch = response.json()
+    print(f"Submitted batch {batch['id']} with {len(bodies)} requests")
+    deadline = asyncio.get_running_loop().time() + timeout
+    while batch["status"] not in FINAL_STATES:
+        if asyncio.get_running_loop().time() >= deadline:
+            print(f"Batch {batch['id']} not finished within {timeout}s, cancelling it")
+            response = await shared_http.post(f"{api_base}/batches/{batch['id']}/cancel", headers=_headers())
+            if response.is_error:
+                print(f"Cancelling batch {batch['id']} failed: {response.status_code}")
+            return {}
+        await asyncio.sleep(poll_interval)
+        response = await shared_http.get(f"{api_base}/batches/{batch['id']}", headers=_headers())
+        response.raise_for_status()
+        batch = response.json()
+    print(f"Batch {batch['id']} {batch['status']}: {batch.get('request_counts')}")
+    if not batch.get("output_file_id"):
+        return {}
+    response = await shared_http.get(f"{api_base}/files/{batch['output_file_id']}/content", headers=_headers())
+    response.raise_for_status()
+    results = {}
+    for line in response.text.splitlines():
+        result = json.loads(line)
+        if result.get("response") and result["response"]["status_code"] == 200:
+            results[result["custom_id"]] = result["response"]["body"]
+    return results
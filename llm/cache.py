@@ -0,0 +1,229 @@
+import hashlib
+import sqlite3
+from collections import OrderedDict
+from contextlib import closing
+from pathlib import Path
+from typing import AsyncIterator, Callable
+
+import numpy as np
+from asgiref.sync import sync_to_async
+from langchain_core.messages import AIMessage
+
+
+class SemanticLLMCache:
+    """
+    Persistent cache for LLM responses, stored in a SQLite database.
+
+    Responses are looked up by the SHA-256 hash of the exact prompt (with collapsed whitespace) and model (name and
+    temperature) first. If there is no exact match, an embedding function is configured and the caller passes a
+    similarity key, the similarity text of the key is embedded and compared (cosine distance) against the most recently cached entries with the same scope, so a
+    response to an almost identical claim (e.g. loading differences of the same citation) is reused too.
+    The scope has to pin everything else the response depends on (e.g. the prompt template, the model and the ids of the
+    retrieved chunks), since the embedding only covers the (truncated) similarity text. Prompts without a similarity key
+    (e.g. batched prompts of several citations) are only looked up by their exact hash.
+
+    Attributes:
+    - path (Path): The location of the SQLite database file.
+    - embedding: The embedding function used for the similarity lookup, either a langchain embeddings object or a
+        chroma embedding function. If None, only exact matches are returned.
+    - max_distance (float): The maximal cosine distance of a cached similarity text to be considered a match.
+    - max_recent (int): The number of most recently cached embeddings kept in memory for the similarity lookup.
+    - hits (int), similar_hits (int), misses (int): The lookup statistics of this process, for observability.
+    """
+
+    def __init__(self, path: Path, embedding=None, max_distance: float = 0.05, max_recent: int = 512):
+        self.path = path
+        self.embedding = embedding
+        self.max_distance = max_distance
+        self.max_recent = max_recent
+        self.hits = self.similar_hits = self.misses = 0
+        with closing(self._connect()) as connection, connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, embedding BLOB, response TEXT NOT NULL, scope TEXT)")
+            if "scope" not in {column[1] for column in connection.execute("PRAGMA table_info(llm_cache)")}:
+                # embeddings of caches created before the scoped similarity lookup cover the whole prompt, so they are
+                # never used for the similarity lookup (their scope stays NULL)
+                connection.execute("ALTER TABLE llm_cache ADD COLUMN scope TEXT")
+            rows = connection.execute("SELECT key, scope, embedding FROM llm_cache WHERE embedding IS NOT NULL AND scope IS NOT NULL "
+                                      "ORDER BY rowid DESC LIMIT ?", (max_recent,)).fetchall()
+        # in memory LRU of the recently cached scopes and (normalized) similarity text embeddings, oldest first
+        self.recent_vectors = OrderedDict((key, (scope, np.frombuffer(vector, dtype=np.float32))) for key, scope, vector in reversed(rows))
+
+    def _connect(self) -> sqlite3.Connection:
+        # a new connection per operation, since sqlite connections can't be shared between threads
+        return sqlite3.connect(self.path)
+
+    @staticmethod
+    def hash(prompt: str, model: str = "") -> str:
+        # whitespace differences (e.g. of the loaded chunks) don't change the prompt for the LLM, the model (name and
+        # temperature) does change the response
+        return hashlib.sha256((" ".join(prompt.split()) + (f"\n{model}" if model else "")).encode()).hexdigest()
+
+    def embed(self, text: str) -> np.ndarray:
+        """
+        Embeds the text with the configured embedding function and normalizes the vector to unit length.
+
+        :param text: the text to be embedded
+        :return: the normalized embedding as float32 vector
+        """
+        if hasattr(self.embedding, "embed_query"):
+            vector = self.embedding.embed_query(text)
+        else:  # chroma embedding function
+            vector = self.embedding([text])[0]
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def lookup(self, prompt: str, similarity: tuple[str, str] = None, model: str = "") -> str | None:
+        """
+        Returns the cached response for the prompt or, if a similarity key is given, for an almost identical similarity
+        text within the same scope.
+
+        :param prompt: the prompt sent to the LLM
+        :param similarity: optional (scope, similarity text), e.g. (hash of template, model and chunk ids, claim)
+        :param model: the identity of the model answering the prompt, see model_identity
+        :return: the cached response content or None on a cache miss
+        """
+        key = self.hash(prompt, model)
+        with closing(self._connect()) as connection:
+            row = connection.execute("SELECT response FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row:
+                self.hits += 1
+                return row[0]
+            scope, text = similarity or (None, None)
+            keys = [cached_key for cached_key, (cached_scope, _) in self.recent_vectors.items() if cached_scope == scope]
+            if not (self.embedding and similarity and keys):
+                self.misses += 1
+                return None
+            distances = 1 - np.stack([self.recent_vectors[cached_key][1] for cached_key in keys]) @ self.embed(text)
+            nearest = int(np.argmin(distances))
+            if distances[nearest] > self.max_distance:
+                self.misses += 1
+                return None
+            row = connection.execute("SELECT response FROM llm_cache WHERE key = ?", (keys[nearest],)).fetchone()
+        self.recent_vectors.move_to_end(keys[nearest])
+        if not row:
+            self.misses += 1
+            return None
+        self.similar_hits += 1
+        return row[0]
+
+    def update(self, prompt: str, response: str, similarity: tuple[str, str] = None, model: str = ""):
+        """
+        Stores the response of the prompt in the cache.
+
+        :param prompt: the prompt sent to the LLM
+        :param response: the content of the LLM response
+        :param similarity: optional (scope, similarity text) the response can be looked up by, see lookup
+        :param model: the identity of the model that answered the prompt, see model_identity
+        """
+        key = self.hash(prompt, model)
+        scope, text = similarity or (None, None)
+        vector = self.embed(text) if self.embedding and similarity else None
+        with closing(self._connect()) as connection, connection:
+            connection.execute("INSERT OR REPLACE INTO llm_cache (key, embedding, response, scope) VALUES (?, ?, ?, ?)",
+                               (key, vector.tobytes() if vector is not None else None, response, scope))
+        if vector is not None:
+            self.recent_vectors[key] = (scope, vector)
+            self.recent_vectors.move_to_end(key)
+            if len(self.recent_vectors) > self.max_recent:
+                self.recent_vectors.popitem(last=False)
+
+
+def response_text(message) -> str:
+    """
+    Returns the text of a (streamed) LLM response: its content, or the arguments of its tool calls if the LLM is bound
+    to a forced tool call (the content is empty then).
+    :param message: the response message, message chunk or string
+    :return: the text to be cached
+    """
+    tool_calls = getattr(message, "additional_kwargs", {}).get("tool_calls")
+    if tool_calls:
+        return "".join(tool_call.get("function", {}).get("arguments") or "" for tool_call in tool_calls)
+    return getattr(message, "content", message)
+
+
+def model_identity(llm) -> str:
+    """
+    Returns the identity of a langchain LLM the cached responses depend on, its model name and temperature.
+    :param llm: the LLM, possibly bound to tools (the identity of the bound LLM is returned)
+    :return: the model name and temperature, e.g. "gpt-3.5-turbo@0.0"
+    """
+    llm = getattr(llm, "bound", llm)
+    return f"{getattr(llm, 'model_name', None) or getattr(llm, 'model', type(llm).__name__)}@{getattr(llm, 'temperature', None)}"
+
+
+class CachedLLM:
+    """
+    Thin wrapper around a langchain LLM that answers prompts from a SemanticLLMCache if possible and only calls the
+    wrapped LLM on a cache miss. For LLMs bound to a forced tool call, the tool call arguments are the answer.
+    A response is only stored if it passes the validate function of the caller (e.g. parses to a valid result), so a
+    truncated or malformed response isn't replayed from the cache on every rerun.
+
+    Attributes:
+    - llm: The wrapped langchain LLM.
+    - cache (SemanticLLMCache): The cache the responses are stored in.
+    - model (str): The identity of the wrapped LLM (model name and temperature), part of the cache keys.
+    - read_cache (bool): Whether cached responses are used. If False, every prompt is sent to the LLM (the valid responses
+        are still stored), e.g. to rescore all checks after changing the scoring.
+    """
+
+    def __init__(self, llm, cache: SemanticLLMCache, read_cache: bool = True):
+        self.llm = llm
+        self.cache = cache
+        self.model = model_identity(llm)
+        self.read_cache = read_cache
+
+    async def lookup(self, prompt: str, similarity: tuple[str, str] = None) -> str | None:
+        return await sync_to_async(self.cache.lookup)(prompt, similarity, self.model) if self.read_cache else None
+
+    async def store(self, prompt: str, response: str, similarity: tuple[str, str] = None, validate: Callable[[str], bool] = None):
+        # without validate function nothing is stored, the response could be unusable
+        if validate and validate(response):
+            await sync_to_async(self.cache.update)(prompt, response, similarity, self.model)
+
+    async def ainvoke(self, prompt: str, similarity: tuple[str, str] = None, validate: Callable[[str], bool] = None):
+        """
+        Asynchronously answers the prompt, either from the cache or by invoking the wrapped LLM.
+
+        :param prompt: the prompt to be answered
+        :param similarity: optional (scope, similarity text) for the similarity lookup, see SemanticLLMCache.lookup
+        :param validate: function returning whether the response text is valid and stored in the cache, if not given
+            the response isn't stored
+        :return: the LLM response, on a cache hit as AIMessage
+        """
+        cached = await self.lookup(prompt, similarity)
+        if cached is not None:
+            return AIMessage(content=cached)
+        response = await self.llm.ainvoke(prompt)
+        await self.store(prompt, response_text(response), similarity, validate)
+        return response
+
+    async def astream(self, prompt: str, until: Callable[[str], bool] = None, similarity: tuple[str, str] = None,
+                      validate: Callable[[str], bool] = None) -> AsyncIterator[str]:
+        """
+        Asynchronously streams the answer of the prompt, either the cached one at once or the tokens of the wrapped LLM
+        as they are generated. The streamed answer is stored in the cache once completed, if it is valid.
+
+        :param prompt: the prompt to be answered
+        :param until: optional function called with each streamed piece of content, if it returns True the stream is
+            stopped early and the content streamed so far is considered the complete answer
+        :param similarity: optional (scope, similarity text) for the similarity lookup, see SemanticLLMCache.lookup
+        :param validate: function returning whether the streamed answer is valid and stored in the cache, if not given
+            the answer isn't stored
+        :return: the pieces of the answers content
+        """
+        cached = await self.lookup(prompt, similarity)
+        if cached is not None:
+            yield cached
+            return
+        pieces = []
+        stream = self.llm.astream(prompt)
+        try:
+            async for chunk in stream:
+                piece = response_text(chunk)
+                pieces.append(piece)
+                yield piece
+                if until and until(piece):
+                    break
+        finally:
+            await stream.aclose()
+        await self.store(prompt, "".join(pieces), similarity, validate)
@@ -0,0 +1,67 @@
+import hashlib
+import sqlite3
+from pathlib import Path
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+class CachingEmbeddings(Embeddings):
+    """
+    Langchain embeddings wrapper that persists the embeddings of all embedded documents in a SQLite database,
+    keyed by the SHA-256 hash of the text and the embedding model. Texts that were already embedded once
+    (e.g. on a reimport of a paper or passages shared by multiple papers) are loaded from the cache instead of
+    being embedded again.
+
+    Attributes:
+    - inner: The wrapped embedding function, either a langchain embeddings object or a chroma embedding function.
+    - path (Path): The location of the SQLite database file.
+    - model (str): The name of the embedding model, part of the cache key since vectors of different models differ.
+    """
+    # maximal number of host parameters in one sqlite query (SQLITE_MAX_VARIABLE_NUMBER of older sqlite versions)
+    query_batch_size = 500
+
+    def __init__(self, inner, path: Path):
+        self.inner = inner
+        self.path = path
+        self.model = getattr(inner, "model_name", None) or getattr(inner, "_model_name", None) or type(inner).__name__
+        with sqlite3.connect(self.path) as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS embedding_cache (hash BLOB, model TEXT, vector BLOB NOT NULL, PRIMARY KEY (hash, model))")
+
+    def _embed(self, texts: list[str]) -> list[list[float]]:
+        if hasattr(self.inner, "embed_documents"):
+            return self.inner.embed_documents(texts)
+        return self.inner(texts)  # chroma embedding function
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        """
+        Returns the embeddings of the texts, only embedding the texts that are not cached yet.
+
+        :param texts: the texts to be embedded
+        :return: the embeddings in the order of the given texts
+        """
+        hashes = [hashlib.sha256(text.encode()).digest() for text in texts]
+        cached = {}
+        with sqlite3.connect(self.path) as connection:
+            unique_hashes = list(set(hashes))
+            for i in range(0, len(unique_hashes), self.query_batch_size):
+                batch = unique_hashes[i:i + self.query_batch_size]
+                rows = connection.execute(f"SELECT hash, vector FROM embedding_cache WHERE model = ? AND hash IN ({','.join('?' * len(batch))})",
+                                          (self.model, *batch))
+                cached.update({text_hash: np.frombuffer(vector, dtype=np.float32).tolist() for text_hash, vector in rows})
+
+            # embed every uncached text only once, even if it occurs multiple times
+            uncached = {text_hash: text for text_hash, text in zip(hashes, texts) if text_hash not in cached}
+            if uncached:
+                vectors = self._embed(list(uncached.values()))
+                connection.executemany("INSERT OR REPLACE INTO embedding_cache (hash, model, vector) VALUES (?, ?, ?)",
+                                       [(text_hash, self.model, np.asarray(vector, dtype=np.float32).tobytes())
+                                        for text_hash, vector in zip(uncached.keys(), vectors)])
+                cached.update({text_hash: list(vector) for text_hash, vector in zip(uncached.keys(), vectors)})
+        return [cached[text_hash] for text_hash in hashes]
+
+    def embed_query(self, text: str) -> list[float]:
+        # queries are hardly ever repeated, so they are not cached
+        if hasattr(self.inner, "embed_query"):
+            return self.inner.embed_query(text)
+        return self.inner([text])[0]
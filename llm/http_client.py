@@ -0,0 +1,38 @@
+import asyncio
+import weakref
+
+import httpx
+
+
+class LoopLocalTransport(httpx.AsyncBaseTransport):
+    """
+    Async httpx transport that keeps a separate connection pool for each event loop.
+
+    The asynchronous processing steps are run with asyncio.run from the (synchronous) views, so every step runs in a
+    new event loop. Pooled connections are bound to the loop they were opened in, so a single pool shared between the
+    steps would hand out connections of already closed loops. With one pool per loop the connections (TLS sessions,
+    HTTP/2 streams) are still reused for all requests of one step, e.g. the concurrently gathered LLM calls.
+
+    Attributes:
+    - transport_kwargs (dict): The keyword arguments the transport of each loop is created with (http2, limits, ...).
+    """
+
+    def __init__(self, **transport_kwargs):
+        self.transport_kwargs = transport_kwargs
+        # the pools are dropped together with their event loop
+        self.transports: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncHTTPTransport] = weakref.WeakKeyDictionary()
+
+    def _transport(self) -> httpx.AsyncHTTPTransport:
+        loop = asyncio.get_running_loop()
+        transport = self.transports.get(loop)
+        if transport is None:
+            transport = self.transports[loop] = httpx.AsyncHTTPTransport(**self.transport_kwargs)
+        return transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await self._transport().handle_async_request(request)
+
+    async def aclose(self):
+        transport = self.transports.pop(asyncio.get_running_loop(), None)
+        if transport is not None:
+            await transport.aclose()
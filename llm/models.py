@@ -1,16 +1,22 @@
+import functools
 import os
 import re
+import sqlite3
+from contextlib import closing
 
 import chromadb
+import httpx
 from chromadb.utils import embedding_functions
 from django.utils.crypto import get_random_string
-from langchain_community.embeddings import SentenceTransformerEmbeddings
 from langchain_openai import ChatOpenAI
 from langchain.llms.openai import OpenAI
 from langchain_community.vectorstores import Chroma
 from langchain_core.documents import Document
 
 from RefCheck.settings import PERSISTENT_DIR
+from llm.cache import SemanticLLMCache, CachedLLM
+from llm.embedding_cache import CachingEmbeddings
+from llm.http_client import LoopLocalTransport
 
 
 # Check if the OPENAI_API_KEY environment variable is set
@@ -34,28 +40,109 @@ If the OPENAI_API_KEY is set to "sk-", it means the user wants to use LocalAI, a
 In this case, the OpenAI model is initialized with a temperature of 0, a DEFAULT_MODEL specified by the user, and a maximum token limit of 3000.
 
 If the OPENAI_API_KEY is not set to "sk-", it means the user wants to use the ChatOpenAI model, which communicates directly with the OpenAI API. 
-In this case, the ChatOpenAI model is initialized with a temperature of 0.0.
+In this case, the ChatOpenAI model (OPENAI_MODEL, by default gpt-3.5-turbo) is initialized with a temperature of 0.0.
 
 The temperature parameter controls the randomness of the model's output. 
 A lower value like 0.0 makes the output more deterministic, while a higher value makes it more diverse.
+
+The ChatOpenAI model shares one tuned async http client with HTTP/2 and a larger connection pool, so the many
+concurrently gathered LLM calls (e.g. while scoring) reuse the TLS connections and are multiplexed instead of
+each opening a new connection.
+
+If SMALL_MODEL is set (only with OpenAI), the bibliography requests containing only few entries are extracted by this
+cheaper and faster model (small_llm), and the checks are scored by it first, only uncertain scores are rescored by the
+default model. Otherwise small_llm is the same model as llm.
+
+Rate limited requests (429) are retried by the OpenAI client with exponential backoff (respecting the Retry-After
+header) up to LLM_MAX_RETRIES times, so bursts of the concurrently gathered requests are slowed down instead of failing.
 """
+shared_http = httpx.AsyncClient(transport=LoopLocalTransport(http2=True, limits=httpx.Limits(max_connections=64, max_keepalive_connections=64)),
+                                timeout=httpx.Timeout(60.0))
+llm_max_retries = int(os.environ.get("LLM_MAX_RETRIES", 6))
 if os.environ["OPENAI_API_KEY"] == "sk-":
     llm = OpenAI(temperature=0,  DEFAULT_MODEL=os.environ["DEFAULT_MODEL"], max_tokens=3000)
 else:
-    llm = ChatOpenAI(temperature=0.0)
+    llm = ChatOpenAI(model=os.environ.get("OPENAI_MODEL", "gpt-3.5-turbo"), temperature=0.0, http_async_client=shared_http,
+                     max_retries=llm_max_retries)
+if "SMALL_MODEL" in os.environ and os.environ["OPENAI_API_KEY"] != "sk-":
+    small_llm = ChatOpenAI(model=os.environ["SMALL_MODEL"], temperature=0.0, http_async_client=shared_http,
+                           max_retries=llm_max_retries)
+else:
+    small_llm = llm
 
 
 '''Chroma DB Setup and configuration of the embeddings we use'''
 """
-Initialize the SentenceTransformerEmbeddings with the model "all-MiniLM-L6-v2". 
-The SentenceTransformerEmbeddings is used to generate embeddings for the documents in the Chroma database.
+The embeddings use the sentence transformer model "all-MiniLM-L6-v2", run by the ONNX runtime
+(exported once to PERSISTENT_DIR/onnx_models) instead of PyTorch for a higher throughput.
+If ONNX_EMBEDDING_QUANTIZE is set, the int8 quantized model is used, which is even faster but slightly alters the embeddings.
+The embeddings are used to generate embeddings for the documents in the Chroma database.
+
+The embedding model is only loaded on first use (not on import), so Django processes that never embed anything
+(e.g. management commands or workers only serving pages) don't load the model weights into memory.
+The module attributes embeddings, cached_embeddings, cached_llm, cached_small_llm and extraction_cache are resolved lazily by the functions below.
 """
-embeddings = SentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2")
-if "OPENAI_EMBEDDING_MODEL" in os.environ:
-    embeddings = embedding_functions.OpenAIEmbeddingFunction(api_key=os.environ["OPENAI_API_KEY"],
-                                                             model_name=os.environ["OPENAI_EMBEDDING_MODEL"])
+@functools.lru_cache(maxsize=1)
+def get_embeddings():
+    if "OPENAI_EMBEDDING_MODEL" in os.environ:
+        return embedding_functions.OpenAIEmbeddingFunction(api_key=os.environ["OPENAI_API_KEY"],
+                                                           model_name=os.environ["OPENAI_EMBEDDING_MODEL"])
+    # imported here, since optimum and transformers take seconds to import
+    from llm.onnx_embeddings import OnnxMiniLMEmbeddings
+    return OnnxMiniLMEmbeddings(PERSISTENT_DIR.joinpath("onnx_models"),
+                                quantize=bool(int(os.environ.get("ONNX_EMBEDDING_QUANTIZE", 0))))
+
+
+@functools.lru_cache(maxsize=1)
+def get_cached_embeddings() -> CachingEmbeddings:
+    """
+    Embeddings wrapper used for embedding new collections, reusing the persisted embeddings of already embedded chunks.
+    """
+    return CachingEmbeddings(get_embeddings(), PERSISTENT_DIR.joinpath("emb_cache.db"))
 
 
+@functools.lru_cache(maxsize=1)
+def get_cached_llm() -> CachedLLM:
+    """
+    LLM wrapper answering repeated prompts (or almost identical claims, if the caller passes a scoped similarity key) from
+    a persistent cache instead of querying the LLM again.
+    Used for the scoring of the checks, since citations get rescored on every (re)import of their source papers.
+    If REFCHECK_NO_CACHE is set, the cached responses are ignored (but still updated).
+    """
+    return CachedLLM(llm, SemanticLLMCache(PERSISTENT_DIR.joinpath("llm_cache.sqlite3"), embedding=get_embeddings()),
+                     read_cache=not bool(int(os.environ.get("REFCHECK_NO_CACHE", 0))))
+
+
+@functools.lru_cache(maxsize=1)
+def get_extraction_cache() -> SemanticLLMCache:
+    """
+    Exact match only cache (without embedding) of the function calling extraction results, e.g. of the bibliography
+    chunks, which are extracted again on every reimport or retry of a paper. Almost identical chunks must not share
+    their extracted entries, so no similarity lookup is done.
+    """
+    return SemanticLLMCache(PERSISTENT_DIR.joinpath("llm_cache.sqlite3"))
+
+
+@functools.lru_cache(maxsize=1)
+def get_cached_small_llm() -> CachedLLM:
+    """
+    Cached wrapper of the smaller model (SMALL_MODEL), used for scoring the checks first. It has its own cache, so its
+    responses are never returned for prompts the default model is asked (e.g. to rescore uncertain checks).
+    """
+    if small_llm is llm:
+        return get_cached_llm()
+    return CachedLLM(small_llm, SemanticLLMCache(PERSISTENT_DIR.joinpath("llm_cache_small.sqlite3"), embedding=get_embeddings()),
+                     read_cache=not bool(int(os.environ.get("REFCHECK_NO_CACHE", 0))))
+
+
+def __getattr__(name: str):
+    # lazy module attributes (PEP 562)
+    lazy_attributes = {"embeddings": get_embeddings, "cached_embeddings": get_cached_embeddings, "cached_llm": get_cached_llm,
+                       "cached_small_llm": get_cached_small_llm, "extraction_cache": get_extraction_cache}
+    if name in lazy_attributes:
+        return lazy_attributes[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 """
 Initialize the PersistentClient for the Chroma database. 
@@ -68,29 +155,39 @@ if "CHROMA_HTTP_HOST" in os.environ and "CHROMA_HTTP_PORT" in os.environ:
     client = chromadb.HTTPClient(os.environ["CHROMA_HTTP_HOST"], int(os.environ["CHROMA_HTTP_PORT"]))
 else:
     client = chromadb.PersistentClient(str(PERSISTENT_DIR.joinpath("chromadb")))
+    # write-ahead logging lets the (many) inserts of an import commit without rewriting the whole journal and doesn't
+    # block concurrent reads. The journal mode is persisted in the database file, so setting it once is sufficient.
+    with closing(sqlite3.connect(PERSISTENT_DIR.joinpath("chromadb", "chroma.sqlite3"))) as chroma_sqlite:
+        chroma_sqlite.execute("PRAGMA journal_mode=WAL")
+
+
+# characters not allowed in chroma collection names, consecutive dots and dots between numbers (valid IP addresses)
+INVALID_COLLECTION_NAME_CHARS = re.compile(r'[^a-zäöüßA-ZÄÖÜ0-9.\-_]|[.]{2,}|(?<=\d)\.(?=\d)')
 
 
-def parseNewCollectionName(name: str):
+def parseNewCollectionName(name: str, existing: set[str] = None):
     """
     Returns a collection name from given name, which is a valid collection name for a chroma db and free to use
     https://docs.trychroma.com/usage-guide#creating-inspecting-and-deleting-collections
 
     :param name: The name of the document to be embedded
+    :param existing: The names of the existing collections, queried from the chroma client if not given
     :return: valid and unique collection name
     """
     # replacing not allowed characters, consecutive dots and dots between numbers to prevent valid IP addresses
-    cleaned_name = re.sub(r'[^a-zäöüßA-ZÄÖÜ0-9.\-_]|[.]{2,}|(?<=\d)\.(?=\d)', '_', name)
-    # more restrictive constraints at the beginning and at the end
-    cleaned_name = re.sub(r'^[^a-zäöüßA-ZÄÖÜ0-9]*|[^a-zäöüßA-ZÄÖÜ0-9]*$', '', cleaned_name)
+    cleaned_name = INVALID_COLLECTION_NAME_CHARS.sub('_', name)
+    # more restrictive constraints at the beginning and at the end, only . - _ are left as non-alphanumeric chars
+    cleaned_name = cleaned_name.strip('.-_')
     # length constraints
     if len(cleaned_name) > 63:
         cleaned_name = cleaned_name[:63]
     if len(cleaned_name) < 3:
         cleaned_name = "collection-" + cleaned_name
     # uniqueness
-    if cleaned_name in [collection.name for collection in client.list_collections()]:
+    if existing is None:
+        existing = {collection.name for collection in client.list_collections()}
+    while cleaned_name in existing:  # if somehow same unique string is appended again to existing name
         cleaned_name = f"{cleaned_name[:59]}_{get_random_string(length=3)}"
-        return parseNewCollectionName(cleaned_name)  # if somehow same unique string is appended again to existing name
     return cleaned_name
 
 
@@ -100,10 +197,9 @@ def createChromaCollection(document_name: str, chunked_document: list[Document])
     the collection as langchain vectorstore and the possibly edited collection name (to be valid and unique).
 
     Note:
-    The Chroma object is initialized with the following parameters:
-    - embedding_function: The specified default embedding function used to generate embeddings for the documents.
-    - persist_directory: (If local and not in http mode) the Chroma database is stored in the PERSISTENT_PATH.
-    - client: The client used to interact with the Chroma database.
+    The chunks are embedded ordered by their length, so each encoder batch contains chunks of similar length and
+    wastes less compute on padding. The embeddings are then added in their original order to the collection directly.
+    The returned Chroma object is initialized like in getChromaCollection.
 
     :param document_name: The name of the document to be embedded as collection
     :param chunked_document: The into langchain Documents chunked document
@@ -111,13 +207,24 @@ def createChromaCollection(document_name: str, chunked_document: list[Document])
     """
     collection_name = parseNewCollectionName(document_name)
     ids = [str(doc.metadata["chunk_id"]) for doc in chunked_document]  # filterable chunk ids, 1-based
-    client.create_collection(name=collection_name)
-    return collection_name, Chroma.from_documents(chunked_document,
-                                                  embedding=embeddings,
-                                                  ids=ids,
-                                                  collection_name=collection_name,
-                                                  persist_directory=str(PERSISTENT_DIR.joinpath("chromadb")),
-                                                  client=client)
+    if not ids:  # e.g. a document without extractable text, nothing to embed
+        client.create_collection(name=collection_name)
+        return collection_name, getChromaCollection(collection_name)
+    # smart batching: embed in length order and restore the original order afterwards
+    order = sorted(range(len(chunked_document)), key=lambda i: len(chunked_document[i].page_content))
+    sorted_vectors = get_cached_embeddings().embed_documents([chunked_document[i].page_content for i in order])
+    vectors = [None] * len(chunked_document)
+    for position, i in enumerate(order):
+        vectors[i] = sorted_vectors[position]
+    collection = client.create_collection(name=collection_name)
+    # all chunks are added in one call (one transaction) unless exceeding the clients maximal batch size
+    batch_size = getattr(client, "max_batch_size", None) or len(ids)
+    for i in range(0, len(ids), batch_size):
+        collection.add(ids=ids[i:i + batch_size],
+                       embeddings=vectors[i:i + batch_size],
+                       documents=[doc.page_content for doc in chunked_document[i:i + batch_size]],
+                       metadatas=[doc.metadata for doc in chunked_document[i:i + batch_size]])
+    return collection_name, getChromaCollection(collection_name)
 
 
 def getChromaCollection(collectionName: str) -> Chroma:
@@ -130,6 +237,6 @@ def getChromaCollection(collectionName: str) -> Chroma:
 
     """
     return Chroma(collection_name=collectionName,
-                  embedding_function=embeddings,
+                  embedding_function=get_embeddings(),
                   persist_directory=str(PERSISTENT_DIR.joinpath("chromadb")),
                   client=client)
@@ -0,0 +1,68 @@
+from pathlib import Path
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+from transformers import AutoTokenizer
+
+
+class OnnxMiniLMEmbeddings(Embeddings):
+    """
+    Langchain embeddings running a sentence transformer model (by default all-MiniLM-L6-v2) with the ONNX runtime
+    instead of PyTorch. The embeddings are mean-pooled and normalized like the sentence transformer ones, so they stay
+    comparable to already embedded collections.
+
+    The model is exported to ONNX once and stored in the given directory, optionally also dynamically quantized to int8
+    (using VNNI instructions on supporting CPUs), which is faster but slightly alters the embeddings.
+
+    Attributes:
+    - model_name (str): The name of the model, including a suffix if quantized. Used as key of the embedding cache.
+    - batch_size (int): The number of texts embedded in one ONNX runtime call.
+    - max_length (int): The maximal number of tokens of a text, longer texts are truncated.
+    """
+
+    def __init__(self, model_dir: Path, model_name: str = "sentence-transformers/all-MiniLM-L6-v2", quantize: bool = False,
+                 batch_size: int = 64, max_length: int = 256):
+        self.model_name = model_name + ("-int8" if quantize else "")
+        self.batch_size = batch_size
+        self.max_length = max_length
+
+        export_dir = model_dir.joinpath(model_name.replace("/", "__"))
+        if not export_dir.exists():
+            model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True, provider="CPUExecutionProvider")
+            model.save_pretrained(export_dir)
+            AutoTokenizer.from_pretrained(model_name).save_pretrained(export_dir)
+        file_name = "model.onnx"
+        if quantize:
+            quantized_dir = export_dir.with_name(export_dir.name + "-int8")
+            if not quantized_dir.exists():
+                quantizer = ORTQuantizer.from_pretrained(export_dir)
+                quantizer.quantize(save_dir=quantized_dir,
+                                   quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False))
+                AutoTokenizer.from_pretrained(export_dir).save_pretrained(quantized_dir)
+            export_dir, file_name = quantized_dir, "model_quantized.onnx"
+        self.tokenizer = AutoTokenizer.from_pretrained(export_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(export_dir, file_name=file_name, provider="CPUExecutionProvider")
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        """
+        Embeds the texts in batches with the ONNX runtime.
+
+        :param texts: the texts to be embedded
+        :return: the normalized embeddings in the order of the given texts
+        """
+        vectors = []
+        for i in range(0, len(texts), self.batch_size):
+            inputs = self.tokenizer(texts[i:i + self.batch_size], padding=True, truncation=True,
+                                    max_length=self.max_length, return_tensors="np")
+            token_embeddings = self.model(**inputs).last_hidden_state
+            # mean pooling over the not padded tokens
+            mask = np.expand_dims(inputs["attention_mask"], -1).astype(np.float32)
+            pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            vectors.extend(pooled.tolist())
+        return vectors
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
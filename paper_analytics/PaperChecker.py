@@ -1,20 +1,216 @@
 import asyncio
+import hashlib
 import json
+import re
 
 from asgiref.sync import sync_to_async
 from langchain_community.vectorstores.chroma import Chroma
+from langchain_core.documents import Document
+from langchain_core.language_models import BaseChatModel
 
 from llm import models as llm_module
+from llm.cache import CachedLLM
 from paper_analytics import prompts_compare
-from paper_manager.models import Paper, Source, Check
+from paper_manager.models import Paper, Source, Check, Citation
+
+try:  # optional, more tolerant parser (trailing commas, single quotes, comments, ...)
+    import json5
+except ImportError:
+    json5 = None
+
+JSON_FENCE = re.compile(r"^\s*```(?:json)?\s*(.*?)\s*```\s*$", re.DOTALL | re.IGNORECASE)
+JSON_OBJECT = re.compile(r"\{.*\}", re.DOTALL)
+# citation markers (IEEE [3], [3, 4], [3-5] or APA (Smith et al., 2010)) and the words of citation texts
+CLAIM_MARKER = re.compile(r'\[\s*\d+(?:\s*[,–-]\s*\d+)*\s*\]|\([^()]*\d{4}[a-z]?\)')
+CLAIM_WORD = re.compile(r'\w+')
+
+
+def _extract_json(llm_return: str) -> dict:
+    """
+    Tolerantly parses the JSON object of a LLM response, which can be wrapped in markdown fences or surrounded by text
+    :param llm_return: the content of the LLM response
+    :return: the parsed JSON object
+    :raises ValueError: if no valid JSON object could be salvaged (json.JSONDecodeError is a subclass)
+    """
+    try:
+        return json.loads(llm_return)
+    except json.JSONDecodeError as error:
+        last_error = error
+    fenced = JSON_FENCE.match(llm_return)
+    candidates = [fenced.group(1)] if fenced else []
+    found = JSON_OBJECT.search(llm_return)
+    if found:
+        candidates.append(found.group(0))
+    for candidate in candidates:
+        try:
+            return json.loads(candidate)
+        except json.JSONDecodeError as error:
+            last_error = error
+        if json5:
+            try:
+                return json5.loads(candidate)
+            except ValueError as error:
+                last_error = error
+    raise last_error
+
+
+def _validate_score(result) -> dict:
+    """
+    Validates a parsed scoring result once, right after parsing, so incomplete results are treated like invalid JSON
+    instead of failing while storing them
+    :param result: the parsed scoring result of one citation
+    :return: the result with the score as integer between 0 and 100
+    :raises ValueError: if a property of the scoring schema is missing or the score is not a number
+    """
+    if not isinstance(result, dict):
+        raise ValueError(f"scoring result {result} is not an object")
+    missing = [key for key in prompts_compare.SCORE_PROPERTIES if key not in result]
+    if missing:
+        raise ValueError(f"scoring result {result} misses {missing}")
+    try:
+        score = round(float(result['score']))
+    except (TypeError, ValueError) as error:
+        raise ValueError(f"score {result['score']} is not a number") from error
+    return {**result, 'score': min(max(score, 0), 100)}
+
+
+def json_object_end_detector():
+    """
+    Creates a function that is incrementally fed with the pieces of a streamed LLM response and returns True as soon
+    as the first JSON object of the response is closed, so the rest of the response doesn't need to be awaited.
+    :return: the detector function taking the next piece of the response
+    """
+    depth = 0
+    in_string = False
+    escaped = False
+
+    def feed(piece: str) -> bool:
+        nonlocal depth, in_string, escaped
+        for char in piece:
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == "\\":
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char == "{":
+                depth += 1
+            elif char == "}" and depth > 0:
+                depth -= 1
+                if depth == 0:
+                    return True
+        return False
+
+    return feed
+
+
+def normalize_claim(text: str) -> str:
+    """
+    Normalizes a citation text for finding duplicates, e.g. the same claim citing a work at multiple places
+    :param text: the text of the citation
+    :return: the lowercase words of the text without citation markers, punctuation and whitespace differences
+    """
+    return " ".join(CLAIM_WORD.findall(CLAIM_MARKER.sub(" ", text.lower())))
+
+
+# the cached LLMs bound to the forced scoring tool calls, by tool name and cached LLM
+_scoring_llms: dict[tuple[str, int], CachedLLM] = {}
+
+
+def parse_scores(llm_return: str, count: int, verbose: bool = False) -> dict[int, dict]:
+    """
+    Parses and validates the scoring results of a LLM response, of the batch prompt for multiple citations and of the
+    single citation prompt for one citation
+    :param llm_return: the content of the LLM response
+    :param count: the number of scored citations
+    :param verbose: whether invalid responses and results are logged
+    :return: the validated scoring results by index of the citation, invalid or missing results are left out
+    """
+    try:
+        parsed = _extract_json(llm_return)
+        results = parsed["results"] if count > 1 else [{**parsed, "citation_id": 0}]
+    except (ValueError, KeyError, TypeError):
+        if verbose:
+            print(f"LLM return {llm_return} is not a valid json")
+        return {}
+    results_by_id = {}
+    for result in results:
+        try:
+            results_by_id[int(result["citation_id"])] = _validate_score(result)
+        except (ValueError, KeyError, TypeError) as error:
+            if verbose:
+                print(f"Skipping invalid scoring result: {error}")
+    return {i: result for i, result in results_by_id.items() if 0 <= i < count}
+
+
+def uses_scoring_tools() -> bool:
+    # only chat models support (forced) tool calls, the LocalAI completion models use the prompts with JSON instructions
+    return isinstance(llm_module.llm, BaseChatModel)
+
+
+def get_scoring_llm(tool: dict, cached_llm: CachedLLM) -> CachedLLM:
+    """
+    Returns the cached LLM forced to answer by calling the given scoring tool, sharing the cache of the plain cached LLM.
+    The streamed and cached answer is the JSON of the tool call arguments.
+    :param tool: the OpenAI tool definition of the scoring function
+    :param cached_llm: the plain cached LLM whose model and cache are used
+    :return: the cached LLM bound to the tool
+    """
+    name = tool["function"]["name"]
+    key = (name, id(cached_llm))
+    if key not in _scoring_llms:
+        bound_kwargs = {"tools": [tool], "tool_choice": {"type": "function", "function": {"name": name}}}
+        if not getattr(cached_llm.llm, "openai_api_base", None):
+            # routes all scoring requests (sharing the tool definition and instructions as prefix) to the same OpenAI
+            # prompt cache, like the extraction requests
+            bound_kwargs["extra_body"] = {"prompt_cache_key": f"refcheck-{name}"}
+        bound_llm = cached_llm.llm.bind(**bound_kwargs)
+        _scoring_llms[key] = CachedLLM(bound_llm, cached_llm.cache, read_cache=cached_llm.read_cache)
+    return _scoring_llms[key]
+
+
+def format_chunks(chunks: list[Document]) -> str:
+    # built in one join, in the same format as before, so cached responses stay valid
+    return "".join(f"chunk {chunk.metadata['chunk_id']}:\n\"{chunk.page_content}\"\n" for chunk in chunks)
+
+
+def similarity_key(cached_llm: CachedLLM, template: str, claim: str, chunks: str) -> tuple[str, str]:
+    """
+    Returns the key for the similarity lookup of a single citations scoring in the LLM cache. Only the claim is embedded
+    (not the static instructions the prompts start with), the scope pins the model, the prompt template and the exact
+    relevant chunks, so different claims citing the same chunks never match.
+    :param cached_llm: the plain cached LLM to be queried
+    :param template: the unformatted prompt template
+    :param claim: the text of the citation
+    :param chunks: the formatted relevant chunks of the source paper
+    :return: the scope and the similarity text
+    """
+    return hashlib.sha256(f"{cached_llm.model}\n{template}\n{chunks}".encode()).hexdigest(), claim
 
 
 class PaperChecker:
     used_source_chunks = 10
+    # upper bounds of simultaneously running LLM requests & chroma queries to not run into rate limits/lock contention
+    # the LLM requests are batches of checks, so with ~2-4k tokens each 16 requests stay well below the token limits of
+    # the lower OpenAI tiers for gpt-4o-mini, rate limited requests are retried with backoff (llm.models.llm_max_retries)
+    max_llm_concurrency = 16
+    max_chroma_concurrency = 8
+    # the checks of a source are scored in batches of up to this many citations (and characters) per LLM request
+    checks_per_call = 8
+    max_batch_prompt_chars = 40000
+    # scores of the smaller model (if configured) in this range are uncertain, so the default model scores them again
+    uncertain_score_range = (30, 70)
 
 
     def __init__(self, paper: Paper, ):
         self.paper = paper
+        self.llm_semaphore = asyncio.Semaphore(self.max_llm_concurrency)
+        self.chroma_semaphore = asyncio.Semaphore(self.max_chroma_concurrency)
+        # the duplicates of the scored checks by check id, getting the same scoring result
+        self.duplicate_checks: dict[int, list[Check]] = {}
 
     async def score(self, new_source_papers: [Paper] = None):
         """
@@ -27,9 +223,10 @@ class PaperChecker:
             new_source_papers = await self.get_source_papers()
         print(new_source_papers)
         await asyncio.gather(*[self.score_source_paper(paper) for paper in new_source_papers[:]])
+        cache = llm_module.cached_llm.cache
+        print(f"LLM cache: {cache.hits} hits, {cache.similar_hits} similar hits, {cache.misses} misses")
 
-    @staticmethod
-    async def score_source_paper(new_source_paper: Paper):
+    async def score_source_paper(self, new_source_paper: Paper):
         """
         Scores all bibliography entries (with the citations that link to it) that reference/represent the given paper
         :param new_source_paper: the paper to be processed whose file got (recently) added/embedded
@@ -38,10 +235,9 @@ class PaperChecker:
             return
         chroma = llm_module.getChromaCollection(new_source_paper.chroma_collection)
         sources = await PaperChecker.get_source_references(new_source_paper)
-        await asyncio.gather(*[PaperChecker.score_source(source, chroma) for source in sources])
+        await asyncio.gather(*[self.score_source(source, chroma) for source in sources])
 
-    @staticmethod
-    async def score_source(source: Source, chroma: Chroma = None):
+    async def score_source(self, source: Source, chroma: Chroma = None):
         """
         Scores the similarity between the sources citations and the source paper
         :param source: the source whose linking citations are to be checked
@@ -52,52 +248,142 @@ class PaperChecker:
             chroma = llm_module.getChromaCollection(source_paper.chroma_collection)
             print("Chroma: ", chroma)
         checks = await PaperChecker.get_checks(source)
-        await asyncio.gather(*[PaperChecker.score_check(check, chroma) for check in checks])
+        if not checks:
+            return
+        # one batched similarity search for the citations of all checks instead of one search per check
+        citations = [await sync_to_async(getattr)(check, 'citation') for check in checks]
+        relevant_chunks = await self.similarity_search_batch(chroma, [citation.text for citation in citations])
+        # checks with the same normalized citation and relevant chunks are only scored once, the others get its result
+        unique_checks = {}
+        for check, citation, chunks in zip(checks, citations, relevant_chunks):
+            key = (normalize_claim(citation.text), tuple(chunk.metadata.get('chunk_id') for chunk in chunks))
+            if key in unique_checks:
+                self.duplicate_checks.setdefault(unique_checks[key][0].id, []).append(check)
+            else:
+                unique_checks[key] = (check, citation, chunks)
+        # consecutive checks are packed into batches up to the maximal number of checks and prompt size
+        batches = [[]]
+        batch_chars = 0
+        for check, citation, chunks in unique_checks.values():
+            chars = len(citation.text) + sum(len(chunk.page_content) for chunk in chunks)
+            if batches[-1] and (len(batches[-1]) >= self.checks_per_call or batch_chars + chars > self.max_batch_prompt_chars):
+                batches.append([])
+                batch_chars = 0
+            batches[-1].append((check, citation, chunks))
+            batch_chars += chars
+        await asyncio.gather(*[self.score_checks_batch(batch, chroma) for batch in batches if batch])
 
-    @staticmethod
-    async def score_check(check: Check, chroma: Chroma):  # TODO add constraints like pages
+    async def score_checks_batch(self, batch: list[tuple[Check, Citation, list[Document]]], chroma: Chroma):
         """
-        Scores the similarity between the check/citation and the source paper
-        :param check: the check to be scored
+        Scores multiple checks in one LLM request. If a smaller model is configured, it scores the checks first and only
+        the checks with an uncertain score (or without a valid result) are scored again by the default model. Checks
+        missing in the response of a batch are scored separately.
+        :param batch: the checks with their citations and the relevant chunks of the source paper
         :param chroma: the chroma collection of the sources paper
         """
-        citation = await sync_to_async(getattr)(check, 'citation')
-        reference = await sync_to_async(getattr)(check, 'reference')
-        relevant_chunks = await chroma.asimilarity_search(citation.text, PaperChecker.used_source_chunks)  # maybe use similarity search with relevance score as indicator or to check the llm response for a too high gap?
-        chunk_string = ""
-        for chunk in relevant_chunks:
-            chunk_string += f"chunk {chunk.metadata['chunk_id']}:\n\"{chunk.page_content}\"\n"
+        items = [(citation, chunks) for _, citation, chunks in batch]
+        results = {}
+        if llm_module.small_llm is not llm_module.llm:
+            results = await self.query_scores(items, llm_module.cached_small_llm)
+            low, high = self.uncertain_score_range
+            results = {i: result for i, result in results.items() if not low <= result['score'] <= high}
+        remaining = [i for i in range(len(batch)) if i not in results]
+        if remaining:
+            escalated = await self.query_scores([items[i] for i in remaining], llm_module.cached_llm)
+            results.update({remaining[j]: result for j, result in escalated.items()})
+        if len(remaining) > 1:
+            missing = [i for i in remaining if i not in results]
+            separate_results = await asyncio.gather(*[self.query_scores([items[i]], llm_module.cached_llm) for i in missing])
+            results.update({i: result[0] for i, result in zip(missing, separate_results) if result})
+        for i, result in results.items():
+            check, citation, chunks = batch[i]
+            await self.apply_score(check, chunks, result)
+            print("Citation: ", citation)
+
+    async def query_scores(self, items: list[tuple[Citation, list[Document]]], cached_llm: CachedLLM) -> dict[int, dict]:
+        """
+        Queries the scoring results of the citations in one request, with the single citation prompt for one citation
+        and the batch prompt for multiple ones
+        :param items: the citations with the relevant chunks of the source paper
+        :param cached_llm: the (plain) cached LLM to be queried, bound to the scoring tools for chat models
+        :return: the validated scoring results by index of the citation, invalid or missing results are left out
+        """
+        batched = len(items) > 1
+        # batched prompts are only looked up by their exact hash, since the results are assigned by their citation ids
+        similarity = None
+        if batched:
+            citations = "\n".join(prompts_compare.score_claims_batch_item.format(citation_id=i, claim=citation.text, chunks=format_chunks(chunks))
+                                  for i, (citation, chunks) in enumerate(items))
+            prompt_kwargs = {"citations": citations}
+            prompt, tool_prompt, tool = prompts_compare.score_claims_batch_prompt, prompts_compare.score_claims_batch_tool_prompt, prompts_compare.SCORE_BATCH_TOOL
+        else:
+            citation, chunks = items[0]
+            # built before entering the LLM semaphore
+            prompt_kwargs = {"claim": citation.text, "chunks": format_chunks(chunks)}
+            prompt, tool_prompt, tool = prompts_compare.score_claim_prompt, prompts_compare.score_claim_tool_prompt, prompts_compare.SCORE_TOOL
         # TODO seperate scoring in multiple steps: 1. extract the validating passage and corresponding chunk_id
         #                                          2. score the passage including an explanation
-        prompt = prompts_compare.score_claim_prompt.format(claim=citation.text, chunks=chunk_string)
-        llm_return = (await llm_module.llm.ainvoke(prompt)).content  # TODO .content only for openAI --> use lanchain Chain
+        template = tool_prompt if uses_scoring_tools() else prompt
+        if not batched:
+            similarity = similarity_key(cached_llm, template, prompt_kwargs["claim"], prompt_kwargs["chunks"])
+        prompt = template.format(**prompt_kwargs)
+        if uses_scoring_tools():
+            cached_llm = get_scoring_llm(tool, cached_llm)
+        async with self.llm_semaphore:
+            # streamed to stop receiving as soon as the JSON object is complete (e.g. skipping trailing markdown/text),
+            # the (possibly early stopped) response is only cached if it parses to valid results
+            pieces = [piece async for piece in cached_llm.astream(prompt, until=json_object_end_detector(), similarity=similarity,
+                                                                  validate=lambda text: bool(parse_scores(text, len(items))))]
+        llm_return = "".join(pieces)
         print("Prompt:")
         print(prompt)
         print(llm_return)
-        try:
-            check_json = json.loads(llm_return)
-        except json.JSONDecodeError:
-            print(f"LLM return {llm_return} is not a valid json")
-            return
-        print(check_json)
-        check.score = check_json['score']
-        # TODO set default differences for score of 100 & 0
-        check.difference_short = check_json['explanation-short']
-        check.semantic_difference = check_json['explanation']
-        if check_json['chunk_id']:
-            try:
-                reference.reference_paper_chunk_id = int(check_json['chunk_id'])
-            except ValueError:
-                print(f"LLM return {check_json['chunk_id']} is not a valid chunk id")
-                reference.reference_paper_chunk_id = relevant_chunks[0].metadata['chunk_id']  # TODO use string search to find the correct chunk
-        reference.extraction = check_json['proof']
-        await check.asave()
-        await reference.asave()
-        print("Relevant chunks:")
-        print(relevant_chunks)
-        # print("Check: ", check)
-        print("Citation: ", citation)
-        print("Reference: ", reference)
+        return parse_scores(llm_return, len(items), verbose=True)
+
+    async def similarity_search_batch(self, chroma: Chroma, texts: list[str]) -> list[list[Document]]:
+        """
+        Queries the most similar chunks of the chroma collection for all texts at once
+        :param chroma: the chroma collection to be queried
+        :param texts: the query texts
+        :return: for each text the list of its most similar chunks, ordered by similarity
+        """
+        # the same citation can be linked to multiple references (aggregated markers), so embed & query each text once
+        unique_texts = list(dict.fromkeys(texts))
+        query_embeddings = await sync_to_async(llm_module.cached_embeddings.embed_documents)(unique_texts)
+        async with self.chroma_semaphore:
+            # not thread sensitive, so the queries of different sources run in parallel in the executor instead of
+            # queuing up in the single thread shared with the ORM calls (the semaphore still bounds them)
+            result = await sync_to_async(chroma._collection.query, thread_sensitive=False)(query_embeddings=query_embeddings,
+                                                                                           n_results=PaperChecker.used_source_chunks,
+                                                                                           include=["documents", "metadatas"])
+        chunks_by_text = {text: [Document(page_content=document, metadata=metadata or {}) for document, metadata in zip(documents, metadatas)]
+                          for text, documents, metadatas in zip(unique_texts, result["documents"], result["metadatas"])}
+        return [chunks_by_text[text] for text in texts]
+
+    async def apply_score(self, check: Check, relevant_chunks: list[Document], check_json: dict):
+        """
+        Stores the scoring result of the LLM in the check and its reference, as well as in its duplicates
+        :param check: the scored check
+        :param relevant_chunks: the chunks of the source paper the check was scored with
+        :param check_json: the parsed scoring result of the check
+        """
+        for scored_check in [check, *self.duplicate_checks.pop(check.id, [])]:
+            reference = await sync_to_async(getattr)(scored_check, 'reference')
+            scored_check.score = check_json['score']
+            # TODO set default differences for score of 100 & 0
+            scored_check.difference_short = check_json['explanation-short']
+            scored_check.semantic_difference = check_json['explanation']
+            if check_json['chunk_id']:
+                try:
+                    reference.reference_paper_chunk_id = int(check_json['chunk_id'])
+                except ValueError:
+                    print(f"LLM return {check_json['chunk_id']} is not a valid chunk id")
+                    reference.reference_paper_chunk_id = relevant_chunks[0].metadata['chunk_id']  # TODO use string search to find the correct chunk
+            reference.extraction = check_json['proof']
+            # only the scored columns are written
+            await scored_check.asave(update_fields=['score', 'difference_short', 'semantic_difference'])
+            await reference.asave(update_fields=['reference_paper_chunk_id', 'extraction'])
+            print("Reference: ", reference)
 
    # Helper functions to query objects from the database in an asynchroneous context
     @sync_to_async
@@ -1,27 +1,424 @@
 import asyncio
+import bisect
+import hashlib
+import itertools
 import time
 import json
+import os
 import re
+from typing import AsyncIterator, Callable, Hashable, Iterator
 
 from asgiref.sync import sync_to_async
-from langchain.chains.base import Chain
+try:  # optional SIMD accelerated regex engine, the citation marker scanning falls back to re if not installed
+    import hyperscan
+except ImportError:
+    hyperscan = None
 from langchain_core.documents import Document
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.runnables import Runnable, RunnableLambda
 from langchain.chains import create_extraction_chain, LLMChain
+from langchain.chains.openai_functions.extraction import _get_extraction_function
+from langchain_openai.chat_models.base import _convert_message_to_dict
 
 from llm import models as llm_module
+from llm.batch_api import run_batch
 from paper_analytics.SourceMatcher import SourceMatcher
+from paper_analytics.bib_fast_parser import parse_bibliography
+from paper_analytics.bib_splitter import clean_chunk, count_entries
 from paper_manager.models import Paper, Source, Check, CitationStyle
 from paper_analytics import prompts_extract_claims as claim_prompts, prompts_bibliography as bib_prompts
 from paper_retriever.PaperImporter import PaperImporter
 
+# Precompiled citation marker patterns
+# IEEE citation pattern for single or multiple references, e.g. [3] or [13, 14, 15]. Adjacent markers like [3], [5]
+# share their claim, so they are matched as one aggregated marker, extracted once and split afterwards
+IEEE_CITATION_MARKER = re.compile(r'\[\s*\d+\s*(?:,\s*\d+\s*)*\](?:\s*,?\s*\[\s*\d+\s*(?:,\s*\d+\s*)*\])*')
+# the single reference numbers of an IEEE citation marker
+IEEE_MARKER_NUMBER = re.compile(r'\d+')
+# APA citation pattern for single or multiple references, e.g. (Smith, 2010) or (Smith et al., 2010; Doe, 2012)
+APA_CITATION_MARKER = re.compile(r'\((?:[A-Za-z]+(?:\s+et al\.)?,?\s\d+(?:;\s[A-Za-z]+(?:\s+et al\.)?,\s\d+)*)\)')
+# an APA citation marker with its preceding whitespace, removed from the claim
+APA_CLAIM_MARKER = re.compile(r'\s*' + APA_CITATION_MARKER.pattern)
+# the end of a sentence, followed by the capitalized start of the next one
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+(?=[A-Z])')
+WHITESPACE = re.compile(r'\s+')
+
+
+def compile_hyperscan_database(pattern: re.Pattern):
+    if not hyperscan:
+        return None
+    database = hyperscan.Database()
+    # UTF-8 with Unicode properties, so \s and \d match like in re (e.g. NBSP between markers, common in PDF extracts)
+    database.compile(expressions=[pattern.pattern.encode()], ids=[0], elements=1,
+                     flags=[hyperscan.HS_FLAG_SOM_LEFTMOST | hyperscan.HS_FLAG_UTF8 | hyperscan.HS_FLAG_UCP])
+    return database
+
+
+# the citation marker pattern of each citation style
+CITATION_MARKER_PATTERNS = {CitationStyle.IEEE: IEEE_CITATION_MARKER, CitationStyle.APA: APA_CITATION_MARKER}
+# hyperscan databases of the citation marker patterns (None if hyperscan is not installed)
+CITATION_MARKER_DATABASES = {pattern: compile_hyperscan_database(pattern) for pattern in (IEEE_CITATION_MARKER, APA_CITATION_MARKER)}
+
+
+def find_citation_markers(pattern: re.Pattern, text: str) -> list[str]:
+    """
+    Finds all non-overlapping matches of the citation marker pattern in the text, like pattern.findall(text), but
+    scanned with hyperscan if available.
+    :param pattern: the precompiled citation marker pattern
+    :param text: the text to be scanned
+    :return: the matched citation markers in order of occurrence
+    """
+    return find_citation_markers_in_texts(pattern, [text])[0]
+
+
+def find_citation_markers_in_texts(pattern: re.Pattern, texts: list[str]) -> list[list[str]]:
+    """
+    Finds the citation markers of multiple texts (e.g. all chunks of a paper) in a single hyperscan scan of the texts
+    joined by null characters, which none of the marker patterns matches, so no match spans two texts.
+    :param pattern: the precompiled citation marker pattern
+    :param texts: the texts to be scanned
+    :return: for each text the matched citation markers in order of occurrence
+    """
+    database = CITATION_MARKER_DATABASES.get(pattern)
+    if not database:
+        return [pattern.findall(text) for text in texts]
+    encoded = [text.encode() for text in texts]
+    data = b"\0".join(encoded)
+    # the byte offset of each text in the joined data
+    offsets = list(itertools.accumulate((len(text) + 1 for text in encoded[:-1]), initial=0))
+    matches = []
+    database.scan(data, match_event_handler=lambda _, start, end, flags, context: matches.append((start, end)))
+    # hyperscan reports all (also overlapping and shorter) matches, so only keep the leftmost-longest non-overlapping
+    # ones like the greedy re matching does
+    markers = [[] for _ in texts]
+    last_end = 0
+    for start, end in sorted(matches, key=lambda match: (match[0], -match[1])):
+        if start >= last_end:
+            markers[bisect.bisect_right(offsets, start) - 1].append(data[start:end].decode())
+            last_end = end
+    return markers
+
+# The chains are stateless regarding their inputs, so each chain is only built once per prompt and LLM and shared
+# between all extractions instead of rebuilding it (including the function calling schema) for every paper.
+# Keyed by the ids, since the langchain prompts and models are not hashable. The chains hold references to both,
+# so the ids can't be reused while cached.
+_chains: dict[tuple[str, int, int], Runnable] = {}
+
+
+def get_llm_chain(prompt, llm) -> LLMChain:
+    key = ("llm", id(prompt), id(llm))
+    if key not in _chains:
+        _chains[key] = LLMChain(llm=llm, prompt=prompt, verbose=True)
+    return _chains[key]
+
+
+def parse_extraction_tool_call(message: BaseMessage) -> dict:
+    """
+    Parses the arguments of the forced information_extraction tool call into the output format of the langchain
+    extraction chain, so both chain variants can be used interchangeably.
+    :param message: the response of the chat model
+    :return: the extracted entities as {"text": [...]}
+    """
+    for tool_call in message.additional_kwargs.get("tool_calls") or []:
+        if tool_call["function"]["name"] == "information_extraction":
+            return {"text": json.loads(tool_call["function"]["arguments"], strict=False).get("info", [])}
+    return {"text": []}
+
+
+def get_extraction_model(schema: dict, prompt, llm) -> Runnable:
+    """
+    Returns the (shared) chat model bound to the forced information_extraction tool call (tool_choice), so the
+    structured entries are returned directly by a single request.
+    :param schema: the json schema of a single extracted entity
+    :param prompt: the prompt of the extraction, its static prefix determines the prompt cache key
+    :param llm: the chat model of the extraction
+    :return: the bound chat model
+    """
+    key = ("tool", id(prompt), id(llm))
+    if key not in _chains:
+        tool = {"type": "function", "function": _get_extraction_function(schema)}
+        bound_kwargs = {"tools": [tool], "tool_choice": {"type": "function", "function": {"name": "information_extraction"}}}
+        if not getattr(llm, "openai_api_base", None):
+            # routes all requests of the extraction (sharing the same static prefix) to the same OpenAI prompt
+            # cache, so the prefill of the function schema and system message is reused for all chunks
+            prefix_hash = hashlib.sha256(json.dumps(tool, sort_keys=True).encode() + repr(prompt.messages[:-1]).encode())
+            bound_kwargs["extra_body"] = {"prompt_cache_key": "refcheck-" + prefix_hash.hexdigest()[:16]}
+        _chains[key] = llm.bind(**bound_kwargs)
+    return _chains[key]
+
+
+def get_extraction_chain(schema: dict, prompt, llm, verbose: bool = True) -> Runnable:
+    """
+    Returns the (shared) chain extracting the entities of the schema with function calling. Chat models are forced to
+    call the information_extraction function as tool, so the entities follow the schema, and a request with malformed
+    tool call arguments is retried once. Other models (LocalAI completion models) use the langchain extraction chain.
+    :param schema: the json schema of a single extracted entity
+    :param prompt: the prompt of the extraction
+    :param llm: the model of the extraction
+    :param verbose: whether the langchain extraction chain logs its prompts
+    :return: a runnable returning the extracted entities as {"text": [...]}
+    """
+    key = ("extraction", id(prompt), id(llm))
+    if key not in _chains:
+        if isinstance(llm, BaseChatModel):
+            chain = prompt | get_extraction_model(schema, prompt, llm) | RunnableLambda(parse_extraction_tool_call)
+            # json.JSONDecodeError of the parsed arguments is a ValueError
+            _chains[key] = chain.with_retry(retry_if_exception_type=(ValueError,), stop_after_attempt=2)
+        else:
+            _chains[key] = create_extraction_chain(schema, llm, prompt, verbose=verbose)
+    return _chains[key]
+
+
+def extraction_cache_key(schema: dict, prompt, llm, chain_input: dict) -> str:
+    # the rendered prompt, the schema and the model, so inputs are extracted again after changing either of them
+    return f"{getattr(llm, 'model_name', type(llm).__name__)}\n{json.dumps(schema, sort_keys=True)}\n{prompt.format(**chain_input)}"
+
+
+def extract_apa_claims(text: str) -> list[dict]:
+    """
+    Extracts the APA citations of the text locally instead of by the LLM: each sentence containing citation markers is
+    the claim of its markers (without them), which is a direct citation if it contains a quote.
+    :param text: the text chunk
+    :return: the extracted citations with the properties of the claim extraction schema
+    """
+    extractions = []
+    for sentence in SENTENCE_END.split(text):
+        markers = find_citation_markers(APA_CITATION_MARKER, sentence)
+        if not markers:
+            continue
+        claim = WHITESPACE.sub(" ", APA_CLAIM_MARKER.sub("", sentence)).strip()
+        citation_type = "direct" if '"' in claim or "“" in claim else "indirect"
+        extractions.extend({"claim": claim, "citation_marker": marker, "type": citation_type} for marker in dict.fromkeys(markers))
+    return extractions
+
+
+def marker_window(text: str, markers: list[str], before: int, after: int) -> str:
+    """
+    Cuts the text down to the passage around its citation markers, since the claim of a marker is always adjacent to it
+    (typically in front of it). The window is widened to the surrounding whitespace, so no words are cut.
+    :param text: the text containing the markers
+    :param markers: the citation markers found in the text, in order of occurrence
+    :param before: the number of characters kept before the first marker
+    :param after: the number of characters kept after the last marker
+    :return: the passage from before the first to after the last marker
+    """
+    first = text.find(markers[0])
+    last = text.rfind(markers[-1])
+    if first < 0 or last < 0:
+        return text
+    start = text.rfind(" ", 0, max(first - before, 0)) + 1 if first > before else 0
+    end = text.find(" ", last + len(markers[-1]) + after)
+    return text[start:end if end >= 0 else len(text)]
+
+
+async def abatch_cached(chain: Runnable, schema: dict, prompt, llm, inputs: list[dict], config: dict = None,
+                        batch_api: bool = False) -> list[dict]:
+    """
+    Runs the extraction chain on all inputs like chain.abatch, but answers inputs that were already extracted once (e.g.
+    on a reimport or retry of the same paper) from the persistent extraction cache. Identical inputs within the batch
+    are only extracted once. The cache key contains the model, the schema and the rendered prompt (template, markers
+    and text chunk), so changing either of them extracts the inputs again.
+    :param chain: the extraction chain built from schema, prompt and llm
+    :param schema: the function calling schema of the chain
+    :param prompt: the prompt of the chain, rendered with the inputs as cache key
+    :param llm: the model of the chain
+    :param inputs: the inputs of the chain
+    :param config: the runnable config passed to abatch
+    :param batch_api: whether the missing inputs are extracted as OpenAI Batch API job (see abatch_batch_api)
+    :return: the extraction results in the order of the inputs
+    """
+    cache = llm_module.extraction_cache
+    keys = [extraction_cache_key(schema, prompt, llm, chain_input) for chain_input in inputs]
+    cached = await sync_to_async(lambda: [cache.lookup(key) for key in keys])()
+    results = [{"text": json.loads(entries)} if entries is not None else None for entries in cached]
+    # the first input of each missing key, in order of occurrence
+    first_missing = {}
+    for i, result in enumerate(results):
+        if result is None:
+            first_missing.setdefault(keys[i], i)
+    missing = list(first_missing.values())
+    if missing:
+        missing_inputs = [inputs[i] for i in missing]
+        if batch_api:
+            extracted = await abatch_batch_api(chain, schema, prompt, llm, missing_inputs, config)
+        else:
+            extracted = await chain.abatch(missing_inputs, config=config)
+        # empty extractions aren't cached (like in astream_extraction), so they are extracted again on a rerun
+        await sync_to_async(lambda: [cache.update(keys[i], json.dumps(result["text"])) for i, result in zip(missing, extracted)
+                                     if result["text"]])()
+        extracted_by_key = {keys[i]: result for i, result in zip(missing, extracted)}
+        # duplicates get their own copy of the entries, since the consumers alter them
+        results = [result if result is not None else {"text": [dict(entry) for entry in extracted_by_key[key]["text"]]}
+                   for key, result in zip(keys, results)]
+    return results
+
+
+async def abatch_batch_api(chain: Runnable, schema: dict, prompt, llm, inputs: list[dict], config: dict = None) -> list[dict]:
+    """
+    Runs the extraction of all inputs like chain.abatch, but as one job of the OpenAI Batch API (half the price, answered
+    within 24h), for extractions that are not waited for interactively. Requests failed within the job or not answered
+    within the timeout of run_batch are extracted by the chain afterwards.
+    :param chain: the extraction chain built from schema, prompt and llm, used for the failed requests
+    :param schema: the json schema of a single extracted entity
+    :param prompt: the prompt of the extraction
+    :param llm: the chat model of the extraction
+    :param inputs: the inputs of the chain
+    :param config: the runnable config passed to abatch
+    :return: the extraction results in the order of the inputs
+    """
+    bound_kwargs = dict(get_extraction_model(schema, prompt, llm).kwargs)
+    request = {"model": llm.model_name, "temperature": llm.temperature, **bound_kwargs.pop("extra_body", {}), **bound_kwargs}
+    bodies = {str(i): {**request, "messages": [_convert_message_to_dict(message) for message in prompt.format_messages(**chain_input)]}
+              for i, chain_input in enumerate(inputs)}
+    # requests not answered within the timeout of the job are extracted synchronously by the chain like failed ones
+    responses = await run_batch(bodies, api_base=llm.openai_api_base)
+    results = [None] * len(inputs)
+    for custom_id, body in responses.items():
+        message = body["choices"][0]["message"]
+        try:
+            results[int(custom_id)] = parse_extraction_tool_call(AIMessage(content="", additional_kwargs={"tool_calls": message.get("tool_calls") or []}))
+        except ValueError:
+            print(f"Batch result {custom_id} has malformed tool call arguments")
+    failed = [i for i, result in enumerate(results) if result is None]
+    if failed:
+        for i, result in zip(failed, await chain.abatch([inputs[i] for i in failed], config=config)):
+            results[i] = result
+    return results
+
+
+class StreamedEntriesParser:
+    """
+    Incremental parser of the streamed arguments of the information_extraction tool call ({"info": [{...}, ...]}),
+    returning each extracted entity as soon as its object is closed instead of waiting for the complete response.
+    Tracks the bracket depth and strings (including escapes), so brackets within property values are ignored.
+
+    Attributes:
+    - failed (int): The number of completed entity objects that couldn't be parsed.
+    - closed (bool): Whether the arguments object was closed, i.e. the streamed arguments are complete.
+    """
+    # depth of the entity objects: the arguments object, the info array and the entities
+    entity_depth = 3
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.buffer = []
+        self.failed = 0
+        self.closed = False
+
+    def feed(self, text: str) -> list[dict]:
+        """
+        :param text: the next piece of the streamed tool call arguments
+        :return: the entities completed within the piece
+        """
+        entities = []
+        for char in text:
+            if self.depth >= self.entity_depth:
+                self.buffer.append(char)
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.depth += 1
+                if self.depth == self.entity_depth:
+                    self.buffer = [char]
+            elif char in "}]":
+                self.depth -= 1
+                if self.depth == self.entity_depth - 1 and char == "}":
+                    try:
+                        entities.append(json.loads("".join(self.buffer), strict=False))
+                    except ValueError:
+                        self.failed += 1
+                        print("Skipping unparsable streamed entity: ", "".join(self.buffer))
+                elif self.depth == 0:
+                    self.closed = True
+        return entities
+
+
+async def astream_extraction(schema: dict, prompt, llm, chain_input: dict, entity_key: Callable[[dict], Hashable] = None,
+                             attempts: int = 2) -> AsyncIterator[dict]:
+    """
+    Streams the entities extracted by the function calling extraction one by one as they are generated, so they can be
+    processed while the remaining entities are still generated. Inputs that were already extracted once are answered
+    from the persistent extraction cache. A stream that is truncated, contains unparsable entities or has no entity at
+    all is requested again (like the retry of the extraction chain), entities already streamed by a previous attempt
+    are skipped then. Only complete, non-empty extractions are stored in the cache.
+    :param schema: the json schema of a single extracted entity
+    :param prompt: the prompt of the extraction
+    :param llm: the model of the extraction
+    :param chain_input: the input of the prompt
+    :param entity_key: the identity of an entity to skip it on a retry, by default the entity itself
+    :param attempts: the maximal number of requests of the extraction
+    :return: the extracted entities (copies, the cached ones aren't altered by the consumer)
+    """
+    cache = llm_module.extraction_cache
+    key = extraction_cache_key(schema, prompt, llm, chain_input)
+    cached = await sync_to_async(cache.lookup)(key)
+    if cached is not None:
+        for entity in json.loads(cached):
+            yield entity
+        return
+    entity_key = entity_key or (lambda entity: json.dumps(entity, sort_keys=True))
+    complete = False
+    entities = []
+    if isinstance(llm, BaseChatModel):
+        streamed = set()
+        for attempt in range(attempts):
+            parser = StreamedEntriesParser()
+            entities = []
+            async for message_chunk in (prompt | get_extraction_model(schema, prompt, llm)).astream(chain_input):
+                for tool_call_chunk in message_chunk.additional_kwargs.get("tool_calls") or []:
+                    for entity in parser.feed(tool_call_chunk.get("function", {}).get("arguments") or ""):
+                        entities.append(entity)
+                        if entity_key(entity) not in streamed:
+                            streamed.add(entity_key(entity))
+                            yield dict(entity)
+            complete = parser.closed and not parser.failed and bool(entities)
+            if complete:
+                break
+            print(f"Incomplete streamed extraction (attempt {attempt + 1} of {attempts}): {len(entities)} entities, "
+                  f"{parser.failed} unparsable, {'closed' if parser.closed else 'truncated'}")
+    else:  # completion models don't stream function calls
+        entities = (await get_extraction_chain(schema, prompt, llm).ainvoke(chain_input))["text"]
+        complete = bool(entities)
+        for entity in entities:
+            yield dict(entity)
+    if complete:
+        await sync_to_async(cache.update)(key, json.dumps(entities))
+
+
 """
-The extractor was mainly developed using IEEE and APA citation style, but a recently added function for querying
-the extraction of citations/claims is missing the APA specific component of splitting citation marker that contain 
-multiple references, so it is not fully functional for APA citation style yet.
+The extractor was mainly developed using IEEE and APA citation style. The claims of IEEE papers are extracted by the
+LLM, the ones of APA papers are parsed locally.
 """
 
 
 class PaperExtractor:
+    # upper bound of simultaneously running LLM requests of a batched extraction step
+    max_llm_concurrency = 16
+    # number of bibliography chunks extracted together in one LLM request
+    bib_chunks_per_call = 4
+    # bibliography requests with less entries (counted by their identifiers) are extracted by the smaller model
+    small_model_max_entries = 2
+    # extract the claims as OpenAI Batch API job (half the price, but answered within up to 24h instead of seconds)
+    use_batch_api = bool(int(os.environ.get("REFCHECK_BATCH_API", 0)))
+    # the characters of a chunk sent for the claim extraction before its first and after its last citation marker
+    claim_context_before = 600
+    claim_context_after = 200
+    # number of marked chunks whose claims are extracted together in one LLM request
+    claim_chunks_per_call = 4
+    # claim requests (of up to claim_chunks_per_call chunks) with at most this many distinct markers are extracted by
+    # the smaller model first
+    small_model_max_markers = 6
+
     @staticmethod
     def docs_list_to_dict(docs_list) -> dict[int, Document]:
         """
@@ -48,13 +445,18 @@ class PaperExtractor:
             self.chunked_document = self.docs_list_to_dict(chunked_document)
         else:
             self.chunked_document = self.chroma_get_chunks_to_docs_dict(self.chroma.get())
+        # the chunks and their ids ordered by chunk id to slice the bibliography/content chunks by binary search
+        self.sorted_chunk_ids = sorted(self.chunked_document.keys())
+        self.sorted_chunks = [self.chunked_document[chunk_id] for chunk_id in self.sorted_chunk_ids]
         self.first_bib_chunk_id = None
         self.last_bib_chunk_id = None
         self.llm = llm or llm_module.llm
+        # the cheaper model for requests with only few bibliography entries (the same model if none is configured)
+        self.small_llm = llm or llm_module.small_llm
         # TODO extend for other types and engineer default prompt for unknown citation style
         # the citation style specific prompts for the different llm queries
         self.clean_bib_chunks = {CitationStyle.IEEE: bib_prompts.cleaning_prompt_with_identifier, CitationStyle.APA: bib_prompts.cleaning_prompt, CitationStyle.UNKNOWN: bib_prompts.cleaning_prompt}
-        self.extract_bib_prompts = {CitationStyle.IEEE: bib_prompts.extraction_prompt_IEEE, CitationStyle.APA: bib_prompts.extraction_prompt___, CitationStyle.UNKNOWN: bib_prompts.extraction_prompt___}
+        self.extract_bib_prompts = {CitationStyle.IEEE: bib_prompts.extraction_prompt_IEEE, CitationStyle.APA: bib_prompts.build_extraction_prompt(), CitationStyle.UNKNOWN: bib_prompts.build_extraction_prompt()}
         self.extract_claims_prompts = {CitationStyle.IEEE: claim_prompts.extraction_prompt_IEEE, CitationStyle.APA: claim_prompts.APA}
         # RegEx functions for citation marker extraction from the checked paper
         self.citation_marker_extractor = {CitationStyle.IEEE: self.extract_ieee_citation_marker, CitationStyle.APA: self.extract_apa_citation_marker}
@@ -63,33 +465,27 @@ class PaperExtractor:
         # chroma collections and collect the most relevant of each referenced source
         self.citation_marker_splitter = {CitationStyle.IEEE: self.split_ieee_citation_marker, CitationStyle.APA: self.split_apa_citation_marker}
         # definition of the entity schemas for extracting them with function calling
-        self.source_schema = {
-            "properties": {
-                "reference": {"type": "string"},
-                "title": {"type": "string"},
-                "authors": {"type": "array", "items": {"type": "string"}},
-                "identifier": {"type": "string"},
-                "publisher": {"type": "string"},
-                "year": {"type": "integer"},
-                "url": {"type": "string"},
-                "pages": {"type": "string"},
-                "location": {"type": "string"},
-                "volume": {"type": "string"},
-                "ISBN": {"type": "string"},
-                "DOI": {"type": "string"},
-                "type": {"type": "string"},
-                "language": {"type": "string"},
-            },
-            "required": ["reference", "title", "authors"],
-        }
+        self.source_schema = bib_prompts.EXTRACTION_TOOL_SCHEMA
+        # the source schema extended by the chunk the entry starts in, for extracting multiple chunks in one request
+        self.batch_source_schema = {**self.source_schema,
+                                    "properties": {**self.source_schema["properties"], "chunk_id": {"type": "integer"}}}
         self.check_schema = {
             "properties": {
                 "claim": {"type": "string"},
                 "citation_marker": {"type": "string"},
-                "type": {"type": "string"},
+                # the labels of the CitationType choices, enforced and described by the function calling schema, so
+                # the prompts don't need to explain them
+                "type": {"type": "string", "enum": ["direct", "indirect", "referenced", "unknown"],
+                         "description": "'direct': a direct quote of the referenced work (quotation marks required), "
+                                        "'indirect': a paraphrase or summary of the referenced work (most common), "
+                                        "'referenced': the referenced work only provides background or in depth information, "
+                                        "'unknown': only if the type is not clear"},
             },
             "required": ["claim", "citation_marker", "type"],
         }
+        # the check schema extended by the chunk of the citation, for extracting multiple chunks in one request
+        self.batch_check_schema = {**self.check_schema,
+                                   "properties": {**self.check_schema["properties"], "chunk_id": {"type": "integer"}}}
 
     async def extract(self):
         print("Extracting")
@@ -113,90 +509,199 @@ class PaperExtractor:
 
         # Improvement: Maybe self create extraction chain for improved function specification
         start_time = time.time()
-        cleaning_chain = LLMChain(llm=self.llm, prompt=self.clean_bib_chunks[self.paper.citation_style], verbose=True)
-        extraction_chain = create_extraction_chain(self.source_schema, self.llm, bib_prompts.extraction_prompt___, verbose=True)
-
-        # Parallelized extracting of the bibliography entries for each chunk
-        for chunk_extraction in asyncio.as_completed([self.extract_bib_chunk(cleaning_chain, extraction_chain, chunk) for chunk in bibliography.values()]):
-            chunk_id, entry_list = await chunk_extraction
-            print(f"llm_returns for chunk {str(chunk_id)}: ", entry_list)
-
-            # Parallelized creating of the source & source-paper objects and pdf retrieval for each entry
-            for source_creation in asyncio.as_completed([Source.from_json(self.paper, json_representation, chunk_id) for json_representation in entry_list["text"]]):
-                source, paper = await source_creation
-                if not paper:
-                    continue
-                print(f"source creation for chunk {chunk_id}: ", source, paper)
-
-                # Parallelized pdf retrieval for each source-paper
-                importer = await sync_to_async(PaperImporter)(paper)
-                query_task_list.append(asyncio.create_task(importer.obtain_paper()))
-
-    async def extract_bib_chunk(self, cleaning_chain: Chain, extraction_chain: Chain, chunk: Document) -> (int, list[dict]):
+        extraction_prompt = bib_prompts.build_extraction_prompt(raw=True, batch=True)
+
+        # Batched extracting of the bibliography entries directly from the raw chunks in one concurrent wave,
+        # multiple consecutive chunks are extracted in one request sharing the system prompt
+        chunks = bibliography
+        config = {"max_concurrency": self.max_llm_concurrency}
+        entries_by_chunk = {int(chunk.metadata["chunk_id"]): [] for chunk in chunks}
+        source_creations = []
+        # the chunks whose entries all follow a common pattern are parsed locally, only the others are extracted by the LLM
+        llm_chunks = []
+        for chunk, parsed_entries in zip(chunks, parse_bibliography([chunk.page_content for chunk in chunks], self.paper.citation_style)):
+            if parsed_entries is None:
+                llm_chunks.append(chunk)
+                continue
+            chunk_id = int(chunk.metadata["chunk_id"])
+            entries_by_chunk[chunk_id] = parsed_entries
+            source_creations.extend(asyncio.create_task(self.create_source(dict(entry), chunk_id, query_task_list)) for entry in parsed_entries)
+        groups = [llm_chunks[i:i + self.bib_chunks_per_call] for i in range(0, len(llm_chunks), self.bib_chunks_per_call)]
+        semaphore = asyncio.Semaphore(self.max_llm_concurrency)
+
+        async def extract_group(group: list[Document]):
+            group_chunk_ids = [int(chunk.metadata["chunk_id"]) for chunk in group]
+            chain_input = {"bib_chunks": bib_prompts.format_batch([(chunk_id, chunk.page_content) for chunk_id, chunk in zip(group_chunk_ids, group)])}
+            entry_count = count_entries(chain_input["bib_chunks"], self.paper.citation_style)
+            llm = self.small_llm if entry_count is not None and entry_count <= self.small_model_max_entries else self.llm
+            async with semaphore:
+                # an entry is identified by its chunk and reference text, so a retried stream doesn't create its source twice
+                async for entry in astream_extraction(self.batch_source_schema, extraction_prompt, llm, chain_input,
+                                                      entity_key=lambda entry: (entry.get("chunk_id"), entry.get("reference"))):
+                    # the entries are assigned to the chunks they start in
+                    try:
+                        chunk_id = int(entry.pop("chunk_id", None))
+                    except (TypeError, ValueError):
+                        chunk_id = None
+                    chunk_id = chunk_id if chunk_id in group_chunk_ids else group_chunk_ids[0]
+                    entries_by_chunk[chunk_id].append(entry)
+                    # the sources are created (and their retrieval started) while the remaining entries are still generated
+                    source_creations.append(asyncio.create_task(self.create_source(dict(entry), chunk_id, query_task_list)))
+
+        await asyncio.gather(*(extract_group(group) for group in groups))
+
+        # Fallback for chunks without extracted entries: clean the chunk first and extract from the cleaned text
         # TODO: improve prompts (especially also extracting the citation marker) and the interaction between the two prompts
-        cleaned_chunk = await cleaning_chain.ainvoke({"bib_chunk": chunk.page_content})
-        print(f"cleaned_chunk for chunk {str(chunk.metadata['chunk_id'])}: ", "\n", cleaned_chunk, "\n", chunk.page_content)
-        return int(chunk.metadata["chunk_id"]), await extraction_chain.ainvoke({"bib_chunk": cleaned_chunk})
-        # return int(chunk.metadata["chunk_id"]), await extraction_chain.ainvoke({"bib_chunk": cleaned_chunk})
+        # the entries are assigned to the chunk they start in, so a chunk only continuing the last entry of its predecessor
+        # has none and only chunks with an entry start (or whose entries can't be counted) failed
+        failed = [i for i, chunk in enumerate(chunks) if not entries_by_chunk[int(chunk.metadata["chunk_id"])]
+                  and count_entries(chunk.page_content, self.paper.citation_style) != 0]
+        if failed:
+            # the chunks are split at their entry identifiers locally, only chunks that can't be split are cleaned by the LLM
+            cleaned_texts = {i: clean_chunk(chunks[i].page_content, self.paper.citation_style) for i in failed}
+            llm_cleaned = [i for i in failed if cleaned_texts[i] is None]
+            if llm_cleaned:
+                cleaning_chain = get_llm_chain(self.clean_bib_chunks[self.paper.citation_style], self.llm)
+                cleaned_chunks = await cleaning_chain.abatch([{"bib_chunk": chunks[i].page_content} for i in llm_cleaned], config=config)
+                cleaned_texts.update({i: cleaned["text"] for i, cleaned in zip(llm_cleaned, cleaned_chunks)})
+            fallback_prompt = bib_prompts.build_extraction_prompt()
+            fallback_extraction_chain = get_extraction_chain(self.source_schema, fallback_prompt, self.llm)
+            fallback_extractions = await abatch_cached(fallback_extraction_chain, self.source_schema, fallback_prompt, self.llm,
+                                                       [{"bib_chunk": cleaned_texts[i]} for i in failed], config=config)
+            for i, extraction in zip(failed, fallback_extractions):
+                chunk_id = int(chunks[i].metadata["chunk_id"])
+                entries_by_chunk[chunk_id] = extraction["text"]
+                source_creations.extend(asyncio.create_task(self.create_source(dict(entry), chunk_id, query_task_list))
+                                        for entry in extraction["text"])
+        print(f"bibliography of {len(chunks)} chunks ({len(chunks) - len(llm_chunks)} parsed locally) extracted in {len(groups)} requests in {time.time() - start_time:.2f}s ({len(failed)} cleaned first)")
+        for chunk_id, entries in entries_by_chunk.items():
+            print(f"llm_returns for chunk {str(chunk_id)}: ", entries)
+        await asyncio.gather(*source_creations)
+
+    async def create_source(self, entry: dict, chunk_id: int, query_task_list: list[asyncio.Task]):
+        """
+        Creates the source & source-paper objects of an extracted bibliography entry and starts the pdf retrieval of
+        the source-paper.
+        :param entry: the extracted properties of the bibliography entry
+        :param chunk_id: the id of the chunk the entry starts in
+        :param query_task_list: the list the retrieval task is appended to
+        """
+        source, paper = await Source.from_json(self.paper, entry, chunk_id)
+        if not paper:
+            return
+        print(f"source creation for chunk {chunk_id}: ", source, paper)
+
+        # Parallelized pdf retrieval for each source-paper
+        importer = await sync_to_async(PaperImporter)(paper)
+        query_task_list.append(asyncio.create_task(importer.obtain_paper()))
 
     async def extract_claims(self):
         print(".\n.\n.\n.")
         print("--- EXTRACTION OF CLAIMS (function calling)")
-        chunks = self.get_content_chunks()
-
-        chain = create_extraction_chain(self.check_schema,
-                                        self.llm,
-                                        claim_prompts.extraction_prompt_IEEX,   # hier APA
-                                        verbose=False)
-        for chunk_extraction in asyncio.as_completed([self.extract_content_chunk_claims(chain, chunk) for chunk in chunks.values()]):
-            chunk_id, llm_output = await chunk_extraction
-            print(f"llm_returns for chunk {str(chunk_id)}: ", json.dumps(llm_output["text"], indent=4))
-            if not llm_output["text"]:
-                continue
-            for extraction in llm_output["text"]:
-                for marker in self.citation_marker_splitter[self.paper.citation_style](extraction["citation_marker"]):
-                    # directly await since creation way faster than chunk extraction
-                    await Check.from_extraction(self.paper, chunk_id, extraction["claim"], marker, extraction.get("type", "Unknown"))
-
-    async def extract_content_chunk_claims(self, chain: Chain, chunk: Document) -> (int, list[dict]):
-        marker = self.citation_marker_extractor[self.paper.citation_style](chunk.page_content)
-        if not marker:
-            return int(chunk.metadata["chunk_id"]), {"text_chunk": chunk.page_content, "marker": marker, "text": []}
+        chunks = list(self.get_content_chunks())
+
+        # only chunks containing citation markers need to be passed to the LLM, those are extracted in one batch.
+        # The markers of all chunks are found in one scan.
+        markers = find_citation_markers_in_texts(CITATION_MARKER_PATTERNS[self.paper.citation_style], [chunk.page_content for chunk in chunks])
+        marked_chunks = [(chunk, marker) for chunk, marker in zip(chunks, markers) if marker]
+        if self.paper.citation_style == CitationStyle.APA:
+            # the (author, year) markers are parsed together with their sentences locally, no LLM required
+            for chunk, _ in marked_chunks:
+                for extraction in extract_apa_claims(chunk.page_content):
+                    await self.create_checks(extraction, int(chunk.metadata["chunk_id"]))
+            return
+
+        prompt = claim_prompts.extraction_prompt_IEEX
         # maybe implement 2-step extraction: 1. extract list of claim-marker tuples with one claim for each marker
         #                                    2. extract citations type
-        return int(chunk.metadata["chunk_id"]), await chain.ainvoke({"text_chunk": chunk.page_content, "marker": marker}, verbose=True)
+        # all markers of a chunk are extracted in one call, listed comma-separated and each (repeated) marker only
+        # once. Only the passage around the markers is sent, the text far before the first or after the last one
+        # has no claim
+        inputs = [{"text_chunk": marker_window(chunk.page_content, marker, self.claim_context_before, self.claim_context_after),
+                   "marker": ", ".join(dict.fromkeys(marker))} for chunk, marker in marked_chunks]
+        if self.use_batch_api and isinstance(self.llm, BaseChatModel):
+            chain = get_extraction_chain(self.check_schema, prompt, self.llm, verbose=False)
+            # chunks already extracted once (e.g. on a rerun of the paper) are answered from the extraction cache
+            llm_outputs = await abatch_cached(chain, self.check_schema, prompt, self.llm, inputs,
+                                              config={"max_concurrency": self.max_llm_concurrency}, batch_api=True)
+            for (chunk, _), llm_output in zip(marked_chunks, llm_outputs):
+                print(f"llm_returns for chunk {chunk.metadata['chunk_id']}: ", json.dumps(llm_output["text"], indent=4))
+                for extraction in llm_output["text"]:
+                    await self.create_checks(extraction, int(chunk.metadata["chunk_id"]))
+            return
+
+        semaphore = asyncio.Semaphore(self.max_llm_concurrency)
+        # the checks are created one after another, so a claim extracted from the overlap of two chunks is found as
+        # existing check instead of being created twice
+        creation_lock = asyncio.Lock()
+        chunk_ids = [int(chunk.metadata["chunk_id"]) for chunk, _ in marked_chunks]
+        marker_counts = {chunk_id: len(set(marker)) for chunk_id, (_, marker) in zip(chunk_ids, marked_chunks)}
+        groups = [list(zip(chunk_ids, inputs))[i:i + self.claim_chunks_per_call] for i in range(0, len(inputs), self.claim_chunks_per_call)]
+
+        async def extract_group(group: list[tuple[int, dict]]):
+            group_chunk_ids = [chunk_id for chunk_id, _ in group]
+            if len(group) == 1:
+                schema, group_prompt, chain_input = self.check_schema, prompt, group[0][1]
+            else:
+                # multiple chunks in one request, so the long system message is only sent once for all of them
+                schema, group_prompt = self.batch_check_schema, claim_prompts.extraction_prompt_IEEX_batch
+                chain_input = {"text_chunks": claim_prompts.format_batch([(chunk_id, chunk_input["text_chunk"], chunk_input["marker"])
+                                                                         for chunk_id, chunk_input in group])}
+            group_markers = sum(marker_counts[chunk_id] for chunk_id in group_chunk_ids)
+            llms = [self.llm]
+            if self.small_llm is not self.llm and group_markers <= self.small_model_max_markers:
+                # the smaller model first, the default model only if it didn't extract a citation for every marker
+                llms.insert(0, self.small_llm)
+            # the extracted markers by chunk id, the default model skips the ones already extracted by the smaller model
+            extracted = set()
+            for llm in llms:
+                async with semaphore:
+                    # the checks are created as soon as their entity is streamed, while the rest is still generated
+                    async for extraction in astream_extraction(schema, group_prompt, llm, chain_input,
+                                                               entity_key=lambda extraction: (extraction.get("chunk_id"), extraction.get("citation_marker"))):
+                        try:
+                            chunk_id = int(extraction.pop("chunk_id", group_chunk_ids[0]))
+                        except (TypeError, ValueError):
+                            chunk_id = None
+                        chunk_id = chunk_id if chunk_id in group_chunk_ids else group_chunk_ids[0]
+                        print(f"llm_return for chunk {chunk_id}: ", json.dumps(extraction))
+                        if (chunk_id, extraction.get("citation_marker")) in extracted:
+                            continue
+                        extracted.add((chunk_id, extraction.get("citation_marker")))
+                        async with creation_lock:
+                            await self.create_checks(extraction, chunk_id)
+                if len(extracted) >= group_markers:
+                    break
+
+        await asyncio.gather(*[extract_group(group) for group in groups])
+
+    async def create_checks(self, extraction: dict, chunk_id: int):
+        """
+        Creates the checks of an extracted citation, one for each reference of its (possibly aggregated) marker.
+        :param extraction: the extracted properties of the citation
+        :param chunk_id: the id of the chunk the citation was extracted from
+        """
+        for marker in self.citation_marker_splitter[self.paper.citation_style](extraction["citation_marker"]):
+            await Check.from_extraction(self.paper, chunk_id, extraction["claim"], marker, extraction.get("type", "Unknown"))
 
     @staticmethod
     def extract_ieee_citation_marker(text) -> list[str]:
-        # Define IEEE citation pattern for single or multiple references
-        pattern = r'\[\s*\d+\s*(?:,\s*\d+\s*)*\]'
-
-        # Find all matches using regular expression
-        citations = re.findall(pattern, text)
-
-        if not citations:
-            return []
-
-        return citations
+        # Find all IEEE citation markers with single or multiple references
+        return find_citation_markers(IEEE_CITATION_MARKER, text)
 
     @staticmethod
     def split_ieee_citation_marker(marker):
-        return ["[" + i + "]" for i in re.findall(r'\d+', marker)]
+        return ["[" + i + "]" for i in IEEE_MARKER_NUMBER.findall(marker)]
 
     @staticmethod
     def extract_apa_citation_marker(text):
-        # Define APA citation pattern for single or multiple references
-        pattern = r'\((?:[A-Za-z]+(?:\s+et al\.)?,?\s\d+(?:;\s[A-Za-z]+(?:\s+et al\.)?,\s\d+)*)\)'
-
-        # Find all matches using regular expression
-        citations = re.findall(pattern, text)
-
-        return citations
+        # Find all APA citation markers with single or multiple references
+        return find_citation_markers(APA_CITATION_MARKER, text)
 
     @staticmethod
     def split_apa_citation_marker(marker):
-        raise NotImplementedError("APA citation marker splitting not implemented yet")
-        # return []  # TODO implement
+        # (Smith et al., 2010; Doe, 2012) -> (Smith et al., 2010), (Doe, 2012)
+        return ["(" + part.strip() + ")" for part in marker.strip("() ").split(";") if part.strip()]
 
     async def categorize_chunks(self):
         """
@@ -212,16 +717,18 @@ class PaperExtractor:
         content_chunks = []
         biblio_chunks = []
 
-        for chunk in self.chunked_document:
-            if self.paper.citation_style == "APA":
-                prompt = "Can you find a list of academic papers or articles in this string? Respond 'yes' or 'no', only one word \n"
-            elif self.paper.citation_style == "IEEE":                   # IEEE
-                prompt = "is there a bibliography in this string? Respond 'yes' or 'no', only one word \n"
-            else: # UNKNOWN
-                prompt = "is there a bibliography in this string? Respond 'yes' or 'no', only one word \n"
-            category_prompt = prompt + "this is the text: \n" + chunk.page_content
-            response = llm_module.llm.invoke(category_prompt).content
-            if "yes" in response.lower():
+        if self.paper.citation_style == "APA":
+            prompt = "Can you find a list of academic papers or articles in this string? Respond 'yes' or 'no', only one word \n"
+        elif self.paper.citation_style == "IEEE":                   # IEEE
+            prompt = "is there a bibliography in this string? Respond 'yes' or 'no', only one word \n"
+        else: # UNKNOWN
+            prompt = "is there a bibliography in this string? Respond 'yes' or 'no', only one word \n"
+        chunks = list(self.chunked_document.values())
+        # all chunks are categorized concurrently in one batch
+        responses = await self.llm.abatch([prompt + "this is the text: \n" + chunk.page_content for chunk in chunks],
+                                          config={"max_concurrency": self.max_llm_concurrency})
+        for chunk, response in zip(chunks, responses):
+            if "yes" in response.content.lower():
                 biblio_chunks.append(chunk)
             else:
                 content_chunks.append(chunk)
@@ -236,21 +743,33 @@ class PaperExtractor:
 
         # similarity_search instead of actual string comparison/filtering to be resilient against
         # misspellings & import/loading errors
-        self.first_bib_chunk_id = int(self.chroma.similarity_search(self.paper.start_bibliography, k=1)[0].metadata["chunk_id"])
-        self.last_bib_chunk_id = int(self.chroma.similarity_search(self.paper.end_bibliography, k=1)[0].metadata["chunk_id"])
+        # both entries are embedded and queried together in one batch
+        query_embeddings = llm_module.cached_embeddings.embed_documents([self.paper.start_bibliography, self.paper.end_bibliography])
+        result = self.chroma._collection.query(query_embeddings=query_embeddings, n_results=1, include=["metadatas"])
+        self.first_bib_chunk_id = int(result["metadatas"][0][0]["chunk_id"])
+        self.last_bib_chunk_id = int(result["metadatas"][1][0]["chunk_id"])
         if self.first_bib_chunk_id > self.last_bib_chunk_id:
             raise ValueError("bibliography entries incorrect - firstEntry must be before lastEntry, may due to incorrect similarity search, try to play with the scope of the entered bibliography entries")
         # working on cached chunks for performance gains, could actually work on the chroma db directly
         # return self.chroma_get_chunks_to_docs_dict(self.chroma.get(where={"$gte": firstID, "$lte": lastID}, include=["metadata", "documents"]))
 
-    def get_bibliography_chunks(self) -> dict[int, Document]:
+    def get_bibliography_scope_indices(self) -> (int, int):
+        """
+        helper function to get the positions of the first and last bibliography chunk in the sorted chunks.
+        :return: the index of the first bibliography chunk and the index after the last bibliography chunk
+        """
         if not (self.first_bib_chunk_id and self.last_bib_chunk_id):
             self.calculate_bibliography_scope()
-        return {id: doc for id, doc in self.chunked_document.items() if self.first_bib_chunk_id <= id <= self.last_bib_chunk_id}
+        return (bisect.bisect_left(self.sorted_chunk_ids, self.first_bib_chunk_id),
+                bisect.bisect_right(self.sorted_chunk_ids, self.last_bib_chunk_id))
+
+    def get_bibliography_chunks(self) -> list[Document]:
+        first, end = self.get_bibliography_scope_indices()
+        return self.sorted_chunks[first:end]
         # working on cached chunks for performance gains, could actually work on the chroma db directly
         # return self.chroma.get(where={"chunk_id":{"$in": [self.first_bib_chunk_id, self.last_bib_chunk_id]}})
 
-    def get_content_chunks(self) -> dict[int, Document]:
-        if not (self.first_bib_chunk_id and self.last_bib_chunk_id):
-            self.calculate_bibliography_scope()
-        return {id: doc for id, doc in self.chunked_document.items() if id <= self.first_bib_chunk_id or id >= self.last_bib_chunk_id}
+    def get_content_chunks(self) -> Iterator[Document]:
+        # the first and last bibliography chunk can contain content too, so they are included
+        first, end = self.get_bibliography_scope_indices()
+        return itertools.chain(self.sorted_chunks[:first + 1], self.sorted_chunks[max(end - 1, first + 1):])
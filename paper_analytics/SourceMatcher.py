@@ -1,31 +1,100 @@
+import asyncio
+import re
+import sys
+from collections import defaultdict
+
 from asgiref.sync import sync_to_async
+from django.db.models import Exists, OuterRef, Prefetch, Subquery, prefetch_related_objects
+
+from paper_manager.models import CitationStyle, Check, Source, Reference, author_words
 
-from paper_manager.models import CitationStyle, Paper
+# an APA citation marker, e.g. (Smith, 2014), (Smith & Doe, 2014a) or (Smith et al., 2014)
+APA_CITATION_MARKER = re.compile(r'\(?\s*(?P<authors>[^,]+?)\s*,\s*(?P<year>\d{4}[a-z]?)\s*\)?')
+# the separators of the authors of an APA citation marker
+APA_AUTHOR_SEPARATOR = re.compile(r'\s*(?:&| et al\.?)\s*')
 
 
 class SourceMatcher:
+    # upper bound of simultaneously matched papers to not exhaust the database connections
+    max_db_concurrency = 4
+
+    @staticmethod
+    def prefetch_lookups() -> tuple:
+        """
+        The related objects of the checked paper used by the matchers. Only the checks that are not marked as false
+        positive are prefetched. The current (not replaced) references of each check are prefetched newest first into
+        check.current_references, since the check.reference property would query them again for each check.
+
+        Returns: the lookups to be passed to prefetch_related
+        """
+        return ('sources',
+                Prefetch('checks', queryset=Check.objects.filter(false_positive=False)),
+                Prefetch('checks__references', queryset=Reference.objects.filter(replaced=False).order_by('-id'),
+                         to_attr='current_references'))
 
     @staticmethod
-    async def match_refs_and_sources(paper):
+    async def match_refs_and_sources(paper, prefetched: bool = False):
         """
         This method matches all found citations in the paper to be checked to the corresponding source objects.
         The source object will be saved in the reference object.
         Args:
             paper: the paper that is being checked
+            prefetched: whether the caller already prefetched the SourceMatcher.prefetch_lookups() of the paper
 
         Returns: nothing
 
         """
-        paper = await Paper.objects.prefetch_related('sources', 'checks', 'checks__references').aget(pk=paper.pk)
+        if paper.citation_style not in (CitationStyle.APA, CitationStyle.IEEE):
+            # nothing can be matched, so the related objects don't need to be loaded
+            await SourceMatcher.match_unknown(paper)
+            return
+        if not prefetched:
+            # prefetch on the given instance instead of selecting the paper row again
+            await sync_to_async(prefetch_related_objects)([paper], *SourceMatcher.prefetch_lookups())
         match paper.citation_style:
             case CitationStyle.APA:
                 await SourceMatcher.match_APA(paper)
             case CitationStyle.IEEE:
                 await SourceMatcher.match_IEEE(paper)
-            case _:
-                await SourceMatcher.match_unknown(paper)
 
    
+    @staticmethod
+    async def match_many(papers):
+        """
+        This method matches the citations and sources of multiple papers concurrently, so the database waits of the
+        papers overlap.
+        Args:
+            papers: the papers that are being checked
+
+        Returns: nothing
+
+        """
+        semaphore = asyncio.Semaphore(SourceMatcher.max_db_concurrency)
+
+        async def match(paper):
+            async with semaphore:
+                await SourceMatcher.match_refs_and_sources(paper)
+
+        await asyncio.gather(*[match(paper) for paper in papers])
+
+    @staticmethod
+    async def save_matches(matches: list[tuple[Reference, Source]]):
+        """
+        This method stores the matched sources in their references with one bulk update instead of saving each
+        reference separately.
+        Args:
+            matches: the matched pairs of reference and source
+
+        Returns: nothing
+
+        """
+        references = []
+        for reference, source in matches:
+            reference.source_id = source.pk
+            references.append(reference)
+        if references:
+            await Reference.objects.abulk_update(references, ['source'])
+
     @staticmethod
     async def match_APA(paper):
         """
@@ -37,77 +106,87 @@ class SourceMatcher:
         Returns: nothing
 
         """
+        # the whole matching walks the prefetched objects, so it runs synchronously in one thread pool call instead of
+        # awaiting each attribute access separately
+        await SourceMatcher.save_matches(await sync_to_async(SourceMatcher._match_APA_sync)(paper))
+
+    @staticmethod
+    def _match_APA_sync(paper) -> list[tuple[Reference, Source]]:
+        """
+        Synchronous part of match_APA.
+        Args:
+            paper: The paper that is being checked.
+
+        Returns: the matched pairs of reference and source
+        """
+        matches = []
+        # the prefetched related objects are materialized once
+        sources = list(paper.sources.all())
+        checks = list(paper.checks.all())
 
         # APA reference.citation_marker must have the following format:
         # (authors, year)
         
-        # sort the bib entries alphabetically for the following special case:
+        # index the bib entries by their year, so a reference only has to be compared with the entries of its year
+        bib_index: dict[str, list[tuple[frozenset[str], Source]]] = defaultdict(list)
+        unparsed = []
+        for source in sources:
+            # sources stored before the parsed fields existed are parsed once now
+            if source.parsed_year is None:
+                source.parse_bibliography_entry()
+                unparsed.append(source)
+            if not source.parsed_year:
+                continue
+            entry_authors = frozenset(sys.intern(word) for word in source.parsed_authors)
+            # an entry of e.g. 2014a can also be cited with 2014
+            for entry_year in {source.parsed_year, source.parsed_year[:4]}:
+                bib_index[entry_year].append((entry_authors, source))
+        if unparsed:
+            Source.objects.bulk_update(unparsed, ['parsed_year', 'parsed_authors'])
+        # sort the bib entries of a year by their number of authors for the following special case:
         # x writes a paper in 2014, x and y write a paper together in 2014
         # paper by x alone must come first, so that if only the name of x ist required in the matching search, it must
         # find the paper by x alone first instead of the paper that was written by x and y, which should be matched when
         # searching for a paper that requires x and y as authors
-        bib_entries = {await sync_to_async(getattr)(source,'bibliography_entry'): source for source in await sync_to_async(paper.sources.all)()}
-        sorted_bib_entries = dict(sorted(bib_entries.items, key=lambda item: item[0]))
+        for entries in bib_index.values():
+            entries.sort(key=lambda entry: len(entry[0]))
+        # inverted index of the author words: (year, word) -> positions of the entries of the year containing the word,
+        # so the entries containing all required authors are found by intersecting the positions of the required words
+        # instead of comparing the reference with each entry of the year
+        author_postings: dict[tuple[str, str], set[int]] = defaultdict(set)
+        for entry_year, entries in bib_index.items():
+            for position, (entry_authors, _) in enumerate(entries):
+                for word in entry_authors:
+                    author_postings[(entry_year, word)].add(position)
     
         # for all reference objects
-        for check in await sync_to_async(paper.checks.all)():
-            if check.false_positive:
+        for check in checks:
+            # the newest current reference, like check.reference but from the prefetched ones
+            if not check.current_references:
                 continue
-            reference = await sync_to_async(getattr)(check, 'reference')
+            reference = check.current_references[0]
             
-            # get the reference text
-            reference_text = reference.citation_marker
-
-            # remove the parentheses
-            reference_text = reference_text.replace("(", "")
-            reference_text = reference_text.replace(")", "")
-
             # the first part is about the author or authors, the part behind the comma is about the year
-            authors = reference_text.partition(",")[0]
-            year = reference_text.partition(",")[2]
-
+            marker = APA_CITATION_MARKER.search(reference.citation_marker)
+            if not marker:
+                continue
+            year = marker['year']
 
             # if we only have one name and et al., just the one name is known, so that we can search for it
             # if two names are given with the "&", we know we have to find both
             # if only one name is given, we only have to search for that one
+            # the separators (& and et al.) are replaced by a space, so all author words are collected in one pass
+            required_authors = author_words(APA_AUTHOR_SEPARATOR.sub(' ', marker['authors']))
+            # without a year or any author (e.g. a malformed marker) no entry can be identified, and an empty author set
+            # would be a subset of any entry
+            if not year or not required_authors or year not in bib_index:
+                continue
 
-            # remove the et al.
-            if " et al." in authors:
-                authors = authors.replace(" et al.", "")
-                
-                # put it into an iterable list
-                authors = [authors]
-            # remove the and and put it into an iterable list
-            elif " & " in authors:
-                authors = authors.split(" & ")
-            else:
-                # put it into an iterable list
-                authors = [authors]
-            
-
-            # remove all possible whitespaces in the year identifier
-            year = ''.join(year.split())
-
-
-            # try finding the right bib entry (source object) for the given reference object
-            for identifier in sorted_bib_entries.keys():
-                all_authors = True
-
-                # see if all required authors are in the bibliography identifier
-                for author in authors:
-                    if author not in identifier:
-                        all_authors = False
-
-                # if all required authors are in the bibliography identifier and the year matches, it is the right object
-                if (all_authors == True and year in identifier):
-                    reference.source = sorted_bib_entries[identifier]
-                    await reference.asave()
-
-                    # as we found the right source object, we break from the inner loop
-                    break
-                else:
-                    # else we continue our search
-                    pass
+            # the entries of the references year containing all required authors, the first of them is the right object
+            candidates = set.intersection(*[author_postings.get((year, word), set()) for word in required_authors])
+            if candidates:
+                matches.append((reference, bib_index[year][min(candidates)][1]))
+        return matches
 
     @staticmethod
     async def match_IEEE(paper):
@@ -123,20 +202,35 @@ class SourceMatcher:
 
         # IEEE reference.citation_marker must have the following format:
         # [number]
+        # the match is an exact join of the citation markers and the bibliography identifiers, so it is done by the
+        # database in one UPDATE statement, which requires the identifiers of all sources to be stored
+        await sync_to_async(SourceMatcher._store_bibliography_identifiers)(paper)
+        # if multiple sources share an identifier the first one is matched
+        matching_source = Source.objects.filter(referenced_in=paper,
+                                                _bibliography_identifier=OuterRef('citation_marker')).order_by('pk').values('pk')[:1]
+        await Reference.objects.filter(Exists(matching_source),
+                                       of_check__paper=paper,
+                                       of_check__false_positive=False,
+                                       replaced=False).aupdate(source=Subquery(matching_source))
 
-        # for all reference objects
-        for check in await sync_to_async(paper.checks.all)():
-            if check.false_positive:
-                continue
-            reference = await sync_to_async(getattr)(check, 'reference')
-            for source in paper.sources.all():
-                if reference.citation_marker == await sync_to_async(getattr)(source, 'bibliography_identifier'):
-                    reference.source = source
-                    await reference.asave()
-                    
-                    # we found the source object, so we can break from the inner loop
-                    break
-        return
+    @staticmethod
+    def _store_bibliography_identifiers(paper):
+        """
+        Stores the identifiers of the papers sources that are not set yet (computed from the bibliography entry).
+        Args:
+            paper: The paper whose sources are processed.
+
+        Returns: nothing
+        """
+        sources = list(paper.sources.all())
+        computed = []
+        for source in sources:
+            if not source._bibliography_identifier:
+                # the property computes the identifier and sets it on the source
+                if source.bibliography_identifier:
+                    computed.append(source)
+        if computed:
+            Source.objects.bulk_update(computed, ['_bibliography_identifier'])
 
     @staticmethod
     async def match_unknown(paper):
@@ -149,5 +243,5 @@ class SourceMatcher:
         Returns: nothing
 
         """
-        # not implemented yet
-        pass
+        # not implemented yet, the references stay unmatched (source None)
+        print(f"Matching skipped: no matcher for the citation style '{paper.citation_style}' of paper {paper.pk}")
@@ -0,0 +1,132 @@
+import re
+
+from paper_analytics.bib_splitter import ENTRY_START
+from paper_manager.models import CitationStyle
+
+"""
+Local rule based parser for the bibliography entries of the common case, so only entries in other formats need to be
+extracted by the LLM. IEEE entries of articles and conference papers follow a strict pattern:
+    [12] A. B. Author, C. Author, and D. Author, "Title of the work," in/Journal, vol. 3, no. 2, pp. 1-10, 2019, doi: ...
+The parsed entries have the properties of the extraction schema (prompts_bibliography.EXTRACTION_TOOL_SCHEMA).
+Entries that don't match the pattern (e.g. books with unquoted titles, online resources or entries with "et al.") are not
+parsed, so the LLM extracts them. The type is only set for conference papers and journal articles.
+"""
+
+IDENTIFIER = re.compile(r'^\s*(\[\d+\])\s*')
+# the quoted title, the closing comma/period of IEEE titles is placed inside the quotes
+QUOTED_TITLE = re.compile(r'[“"]\s*(?P<title>[^“”"]{3,}?)\s*[,.]?\s*[”"]\s*[,.]?\s*')
+YEAR = re.compile(r'\b(1[5-9]\d{2}|20\d{2})\b')
+DOI = re.compile(r'(?:\bdoi:\s*|https?://(?:dx\.)?doi\.org/)?\b(10\.\d{4,9}/\S+[^\s.,;])', re.IGNORECASE)
+URL = re.compile(r'https?://\S+[^\s.,;]')
+PAGES = re.compile(r'\bpp?\.\s*(\d+\s*[-–—]\s*\d+|\d+)')
+VOLUME = re.compile(r'\bvol\.\s*[\w.]+(?:\s*,\s*no\.\s*[\w.]+)?', re.IGNORECASE)
+ISBN = re.compile(r'\bISBN(?:-1[03])?:?\s*([\dX][\d\- ]{8,15}[\dX])', re.IGNORECASE)
+AUTHOR_SEPARATOR = re.compile(r'\s*,\s*(?:and\s+)?|\s+and\s+')
+# a name of up to five words (initials or names) without digits
+AUTHOR_NAME = re.compile(r'^[^\W\d_][^\d,;:()\[\]]{0,80}$')
+VENUE_PREFIX = re.compile(r'^(?:in:?\s+)', re.IGNORECASE)
+CONFERENCE = re.compile(r'\b(?:Proc|Conf|Symp|Workshop)', re.IGNORECASE)
+# venues of online resources and reports, whose publisher/year can't be told apart reliably by the pattern
+ONLINE = re.compile(r'\[Online\]|https?://|\bwww\.', re.IGNORECASE)
+# hyphenated line breaks within words and all other whitespace runs of the extracted text
+HYPHENATION = re.compile(r'(?<=[a-z])-\s*\n\s*(?=[a-z])')
+WHITESPACE = re.compile(r'\s+')
+
+
+def merge_chunks(texts: list[str], min_overlap: int = 20, max_overlap: int = 1000) -> tuple[str, list[int]]:
+    """
+    Joins consecutive chunks to one text, removing the overlap of each chunk with its predecessor.
+    :param texts: the texts of the consecutive chunks
+    :param min_overlap: the minimal length of an overlap, shorter matches are considered coincidental
+    :param max_overlap: the maximal length of an overlap (the splitters chunk_overlap is a few hundred characters)
+    :return: the joined text and the offset of each chunk in it
+    """
+    text = ""
+    offsets = []
+    for chunk in texts:
+        overlap = next((length for length in range(min(len(text), len(chunk) - 1, max_overlap), min_overlap - 1, -1)
+                        if text.endswith(chunk[:length])), 0)
+        if text and not overlap:
+            text += "\n"
+        offsets.append(len(text) - overlap)
+        text += chunk[overlap:]
+    return text, offsets
+
+
+def parse_ieee_entry(entry: str) -> dict | None:
+    """
+    Parses an IEEE bibliography entry with quoted title.
+    :param entry: the text of the entry, starting with its identifier
+    :return: the properties of the entry, None if it doesn't match the pattern or misses the title, authors or year
+    """
+    entry = WHITESPACE.sub(" ", HYPHENATION.sub("", entry)).strip()
+    identifier = IDENTIFIER.match(entry)
+    title = QUOTED_TITLE.search(entry)
+    if not identifier or not title:
+        return None
+    author_text = entry[identifier.end():title.start()].strip(" ,")
+    if "et al" in author_text:  # the listed authors are incomplete
+        return None
+    authors = [author for author in AUTHOR_SEPARATOR.split(author_text) if author]
+    if not authors or not all(AUTHOR_NAME.match(author) and len(author.split()) <= 5 for author in authors):
+        return None
+    rest = entry[title.end():]
+    years = YEAR.findall(DOI.sub("", URL.sub("", rest)))
+    if not years:
+        return None
+
+    properties = {"reference": entry, "identifier": identifier.group(1), "title": title.group("title"), "authors": authors,
+                  "year": int(years[-1])}
+    venue_text = rest.split(",")[0].strip(" .")
+    venue = VENUE_PREFIX.sub("", venue_text)
+    if ONLINE.search(venue) or (YEAR.search(venue) and not YEAR.fullmatch(venue)):
+        return None
+    if venue and not YEAR.fullmatch(venue) and not VOLUME.match(venue) and not PAGES.match(venue):
+        properties["publisher"] = venue
+        if venue != venue_text and CONFERENCE.search(venue):
+            properties["type"] = "conference paper"
+    for name, pattern in (("DOI", DOI), ("pages", PAGES), ("ISBN", ISBN)):
+        match = pattern.search(rest)
+        if match:
+            properties[name] = match.group(1)
+    volume = VOLUME.search(rest)
+    if volume:
+        properties["volume"] = volume.group(0)
+    url = URL.search(rest)
+    if url and "doi.org/" not in url.group(0):
+        properties["url"] = url.group(0)
+    if "type" not in properties and "publisher" in properties and volume:  # journal article: Journal, vol. 3, no. 2
+        properties["type"] = "article"
+    return properties
+
+
+PARSERS = {
+    CitationStyle.IEEE: parse_ieee_entry,
+}
+
+
+def parse_bibliography(texts: list[str], style: str) -> list[list[dict] | None]:
+    """
+    Parses the entries of the consecutive bibliography chunks locally. The entries are assigned to the chunk they start
+    in, and a chunk is only considered parsed if all entries starting in it could be parsed.
+    :param texts: the texts of the consecutive bibliography chunks
+    :param style: the citation style of the paper
+    :return: for each chunk the parsed entries, None if the chunk needs to be extracted by the LLM
+    """
+    parser = PARSERS.get(style)
+    if not parser:
+        return [None] * len(texts)
+    text, offsets = merge_chunks(texts)
+    starts = [match.start() for match in ENTRY_START[style].finditer(text)]
+    results: list[list[dict] | None] = [[] for _ in texts]
+    for start, end in zip(starts, starts[1:] + [len(text)]):
+        # the chunk the entry starts in, an entry ends at the next entry or a blank line (e.g. before an appendix)
+        chunk_index = max(i for i, offset in enumerate(offsets) if offset <= start)
+        entry = text[start:end].split("\n\n")[0]
+        parsed = parser(entry)
+        if parsed is None:
+            results[chunk_index] = None
+        elif results[chunk_index] is not None:
+            results[chunk_index].append(parsed)
+    # chunks without any entry are left to the LLM, they may contain entries in an unexpected format
+    return [entries or None for entries in results]
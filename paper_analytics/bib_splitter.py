@@ -0,0 +1,57 @@
+try:  # optional linear time (DFA) regex engine with the interface of re, the splitting falls back to re if not installed
+    import re2 as re
+except ImportError:
+    import re
+
+from paper_manager.models import CitationStyle
+
+"""
+Local replacement of the LLM cleaning pass of bibliography chunks: the entries of a chunk are split at their identifiers
+and separated by exactly three linebreaks, like the cleaning prompts instruct the LLM to do.
+Only citation styles with identifiers at the start of each entry can be split reliably, so for other styles (and
+chunks without any identifier) no entries are returned and the LLM cleaning is still required.
+"""
+
+# the identifier at the start of a line beginning an IEEE bibliography entry, e.g. [3]
+ENTRY_START = {
+    CitationStyle.IEEE: re.compile(r'(?m)^[ \t]*\[\d+\]'),
+}
+ENTRY_SEPARATOR = "\n\n\n"
+
+
+def split_entries(text: str, style: str) -> list[str]:
+    """
+    Splits the bibliography chunk into its entries, each starting with its identifier. Text before the first identifier
+    (e.g. headings or the end of an entry of the previous chunk) is dropped.
+    :param text: the text of the bibliography chunk
+    :param style: the citation style of the paper
+    :return: the entries of the chunk, empty if the style can't be split or no identifier was found
+    """
+    pattern = ENTRY_START.get(style)
+    if not pattern:
+        return []
+    starts = [match.start() for match in pattern.finditer(text)]
+    entries = [text[start:end].strip() for start, end in zip(starts, starts[1:] + [len(text)])]
+    return [entry for entry in entries if entry]
+
+
+def count_entries(text: str, style: str) -> int | None:
+    """
+    Counts the bibliography entries starting in the text by their identifiers.
+    :param text: the text of one or multiple bibliography chunks
+    :param style: the citation style of the paper
+    :return: the number of entry identifiers, None if the entries of the style can't be counted
+    """
+    pattern = ENTRY_START.get(style)
+    return len(pattern.findall(text)) if pattern else None
+
+
+def clean_chunk(text: str, style: str) -> str | None:
+    """
+    Cleans the bibliography chunk locally, formatting it like the LLM cleaning prompts.
+    :param text: the text of the bibliography chunk
+    :param style: the citation style of the paper
+    :return: the entries separated by three linebreaks, None if the chunk couldn't be split
+    """
+    entries = split_entries(text, style)
+    return ENTRY_SEPARATOR.join(entries) if entries else None
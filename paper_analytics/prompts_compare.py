@@ -28,3 +28,60 @@ score_claim_prompt = ("This is the citation:\n\"\"\"{claim}\"\"\"\n\n"
 "\"chunk_id\": The id (integer) of the chunk that validates the claim or that is referenced by the citation.\n"
 "}}"
 )
+
+# Batched variant of score_claim_prompt, scoring multiple citations (each with its own relevant chunks) in one request,
+# so the instructions are only sent once for all of them. Each citation is formatted with score_claims_batch_item.
+score_claims_batch_item = "Citation {citation_id}:\n\"\"\"{claim}\"\"\"\nThese are the relevant chunks of its reference:\n{chunks}\n"
+score_claims_batch_prompt = ("These are citations made in a publication, each with the relevant chunks of its reference:\n\n{citations}\n"
+"I want to check for each citation separately if it is accurate.\n"
+"The citation is accurate if the reference either way underpinns the claim, in the case the citation makes a claim or if the citation only mentions something if the reference is highly related to the citation and referred by the citation.\n"
+"Is each citation accurate?\n"
+"If yes, return the part showing that the citation is really referencing. If no, return in which way they do not have the same content or the references do not validate the citation.\n\n"
+"Return a well-structured JSON object with one result for each citation and the following structure:\n"
+"{{\"results\": [\n"
+"{{\n"
+"\"citation_id\": The id (integer) of the citation.\n"
+"\"score\": __, The approximate percentage number (0-100)of relatedness between the citation and the reference / percentage that the citation is accurately referencing.\n"
+"\"explanation\": The explanation of the score, especially whats missing for 100%.\n"
+"\"explanation-short\": The explanation wrapped up as one bullet point aka up to about 3-8 words.\n"
+"\"proof\": The identical passage from the relevant chunks of the citation that validates its claim / The section that is most likely referenced by the citation. Not the citation itself!\n"
+"\"chunk_id\": The id (integer) of the chunk that validates the claim or that is referenced by the citation.\n"
+"}}, ...]}}"
+)
+
+# The scoring result as function calling schema, so chat models (OpenAI) get the structure from the forced tool call
+# instead of the JSON instructions in each prompt
+SCORE_PROPERTIES = {
+    "score": {"type": "integer", "description": "The approximate percentage number (0-100) of relatedness between the citation and the reference / percentage that the citation is accurately referencing."},
+    "explanation": {"type": "string", "description": "The explanation of the score, especially whats missing for 100%."},
+    "explanation-short": {"type": "string", "description": "The explanation wrapped up as one bullet point aka up to about 3-8 words."},
+    "proof": {"type": "string", "description": "The identical passage from the relevant chunks that validates the citations claim / The section that is most likely referenced by the citation. Not the citation itself!"},
+    "chunk_id": {"type": "integer", "description": "The id of the chunk that validates the claim or that is referenced by the citation."},
+}
+SCORE_TOOL = {"type": "function", "function": {
+    "name": "score_citation",
+    "description": "Stores the scoring result of the citation.",
+    "parameters": {"type": "object", "properties": SCORE_PROPERTIES, "required": list(SCORE_PROPERTIES)},
+}}
+SCORE_BATCH_TOOL = {"type": "function", "function": {
+    "name": "score_citations",
+    "description": "Stores the scoring results of all citations.",
+    "parameters": {"type": "object", "required": ["results"], "properties": {"results": {"type": "array", "items": {
+        "type": "object",
+        "properties": {"citation_id": {"type": "integer", "description": "The id of the citation."}, **SCORE_PROPERTIES},
+        "required": ["citation_id", *SCORE_PROPERTIES],
+    }}}},
+}}
+
+SCORE_INSTRUCTIONS = ("The citation is accurate if the reference either way underpinns the claim, in the case the citation makes a claim or if the citation only mentions something if the reference is highly related to the citation and referred by the citation.\n"
+"If it is accurate, the proof is the part showing that the citation is really referencing. If not, explain in which way they do not have the same content or the references do not validate the citation.\n")
+
+# the prompts used with the scoring tools, the static instructions come first and the varying citations/chunks last,
+# so all scoring requests share the same prefix (tool definition and instructions) for the prompt caching of the API
+score_claim_tool_prompt = ("Check if the citation made in a publication is accurate and call the 'score_citation' function with the result.\n"
++ SCORE_INSTRUCTIONS + "\n"
+"This is the citation:\n\"\"\"{claim}\"\"\"\n\n"
+"These are the relevant chunks of the reference:\n{chunks}")
+score_claims_batch_tool_prompt = ("Check for each of the following citations made in a publication separately if it is accurate and call the 'score_citations' function with one result for each citation.\n"
++ SCORE_INSTRUCTIONS + "\n"
+"These are the citations, each with the relevant chunks of its reference:\n\n{citations}")
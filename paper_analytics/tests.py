@@ -4,8 +4,6 @@ import json
 import django
 import os
 
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-
 from RefCheck.settings import BASE_DIR
 
 #sys.path.append(str(RefCheck.settings.BASE_DIR))  # needed if the IDEs project root is not the same as the django project root
@@ -24,6 +22,7 @@ from paper_retriever.services.SpringerApi import SpringerApi
 import llm.models as llm_module
 from paper_manager.models import Paper, Source, Author, Check
 from paper_retriever.PaperImporter import PaperImporter
+from paper_retriever.text_splitter import get_text_splitter
 from paper_analytics.PaperExtractor import PaperExtractor
 from paper_analytics.SourceMatcher import SourceMatcher
 from paper_analytics.PaperChecker import PaperChecker
@@ -119,7 +118,7 @@ def check_paper_pipeline():
     # Pipeline start
     if new_file:
         print("importing paper -----------------------------")
-        collection, chunks = asyncio.run(PaperImporter(paper).import_paper(RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=200)))
+        collection, chunks = asyncio.run(PaperImporter(paper).import_paper(get_text_splitter(chunk_size=2000, chunk_overlap=200)))
         print(f"embedded {collection._collection.count()} chunks in {collection} respective {collection._collection.name}.\nPeek:\n", json.dumps(collection._collection.get(include= ["documents", "embeddings"], ids=["1", "2", "3"]), indent=4))
         extractor = PaperExtractor(paper, collection, chunks)
     else:
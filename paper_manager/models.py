@@ -1,4 +1,7 @@
 import json
+import re
+import sys
+import unicodedata
 
 from asgiref.sync import sync_to_async
 from django.core.files.storage import default_storage
@@ -24,6 +27,27 @@ Languages = [
     (code, info['name']) for code, info in LANG_INFO.items() if 'name' in info
 ]
 
+# the year of an APA bibliography entry, e.g. 2014 or 2014a
+APA_ENTRY_YEAR = re.compile(r'\b\d{4}[a-z]?\b')
+# a single word of an author name, e.g. Smith, O'Neil or Müller-Lüdenscheidt
+AUTHOR_TOKEN = re.compile(r"[^\W\d_]+(?:['-][^\W\d_]+)*")
+
+
+def author_words(text: str) -> frozenset[str]:
+    """
+    Splits the author names of the text into their normalized words (lowercase, without diacritics), so e.g. Müller
+    and muller are matched. The words are interned, so comparing equal words of different entries is a pointer
+    comparison.
+
+    Parameters:
+    - text (str): The text containing the author names.
+
+    Returns:
+    - frozenset[str]: The set of normalized author words.
+    """
+    words = (unicodedata.normalize('NFKD', token).encode('ascii', 'ignore').decode().lower() for token in AUTHOR_TOKEN.findall(text))
+    return frozenset(sys.intern(word) for word in words if word)
+
 
 class Author(models.Model):
     # string representation of full name
@@ -414,12 +438,38 @@ class Source(models.Model):
     - _bibliography_identifier (str): The bibliography identifier of the source. This is a private attribute.
     - bibliography_entry (str): The bibliography entry of the source.
     - paper (Paper): The paper that the source refers to.
+    - parsed_year (str): The year parsed from the bibliography entry (APA), empty if the entry has no year, None if not parsed yet.
+    - parsed_authors (list[str]): The normalized words of the author part of the bibliography entry (APA).
     """
     referenced_in = models.ForeignKey(Paper, on_delete=models.CASCADE, related_name='sources')
     chunk_id = models.IntegerField()
     _bibliography_identifier = models.CharField(max_length=255, null=True, blank=True)
     bibliography_entry = models.TextField(max_length=511)
     paper = models.ForeignKey(Paper, on_delete=models.CASCADE, related_name='source_references')
+    # parsed once on saving, so the matching of the citation markers doesn't need to parse the entries on each run
+    parsed_year = models.CharField(max_length=5, null=True, blank=True)
+    parsed_authors = models.JSONField(default=list, blank=True)
+
+    def parse_bibliography_entry(self):
+        """
+        Parse the year and the words of the author names (the part before the year) of the bibliography entry in APA
+        style, e.g. "Smith, J., & Doe, A. (2014a). Title...", into parsed_year and parsed_authors.
+        """
+        year = APA_ENTRY_YEAR.search(self.bibliography_entry)
+        if not year:
+            self.parsed_year, self.parsed_authors = '', []
+            return
+        self.parsed_year = year.group(0)
+        self.parsed_authors = sorted(author_words(self.bibliography_entry[:year.start()]))
+
+    def save(self, *args, **kwargs):
+        """
+        Save the source, parsing the bibliography entry before.
+        """
+        self.parse_bibliography_entry()
+        if kwargs.get('update_fields') is not None and 'bibliography_entry' in kwargs['update_fields']:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'parsed_year', 'parsed_authors'}
+        super().save(*args, **kwargs)
 
     @property
     def bibliography_identifier(self):
@@ -275,7 +275,7 @@ class UpdatePaperView(View):
         if form.is_valid():
             form.save()
             collection, chunks = asyncio.run(PaperImporter(source.paper).import_paper())
-            PaperChecker.score_source_paper(source.paper)  # TODO add spinner or something to indicate processing
+            asyncio.run(PaperChecker(source.referenced_in).score_source_paper(source.paper))  # TODO add spinner or something to indicate processing
 
             if redirect_to == 'missing_sources':
                 return redirect('missing_sources', id=source.referenced_in.id)
@@ -0,0 +1,39 @@
+"""
+Text splitters for chunking the imported papers. The native splitter (semantic-text-splitter) splits at the same
+semantic levels as the RecursiveCharacterTextSplitter (paragraphs, sentences, words), but in compiled code, which is
+considerably faster for long papers. It is wrapped as langchain TextSplitter, so split_documents still returns
+Documents with the metadata of the loaded pages.
+"""
+try:  # optional splitter implemented in Rust, the chunking falls back to the langchain splitter if not installed
+    from semantic_text_splitter import TextSplitter as NativeSplitter
+except ImportError:
+    NativeSplitter = None
+from langchain.text_splitter import TextSplitter, RecursiveCharacterTextSplitter
+
+
+class NativeTextSplitter(TextSplitter):
+    """
+    Langchain text splitter delegating the splitting of each text to the Rust implementation of semantic-text-splitter.
+
+    Attributes:
+    - splitter: The native splitter, configured with the chunk size (in characters) and overlap.
+    """
+
+    def __init__(self, chunk_size: int = 2000, chunk_overlap: int = 200, **kwargs):
+        super().__init__(chunk_size=chunk_size, chunk_overlap=chunk_overlap, **kwargs)
+        self.splitter = NativeSplitter(chunk_size, overlap=chunk_overlap)
+
+    def split_text(self, text: str) -> list[str]:
+        return self.splitter.chunks(text)
+
+
+def get_text_splitter(chunk_size: int = 2000, chunk_overlap: int = 200) -> TextSplitter:
+    """
+    Returns the native text splitter if semantic-text-splitter is installed, otherwise the RecursiveCharacterTextSplitter.
+    :param chunk_size: the maximal number of characters of a chunk
+    :param chunk_overlap: the number of characters consecutive chunks overlap
+    :return: the text splitter
+    """
+    if NativeSplitter:
+        return NativeTextSplitter(chunk_size, chunk_overlap)
+    return RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)